@@ -14,9 +14,12 @@ import cico_umbrella
 import cico_a4e
 import sys
 import atexit
+import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 import umbrella_log_collector
 import meraki_dashboard_link_parser
+import meraki_cache
+import meraki_webhook_receiver
 
 
 # ========================================================
@@ -88,26 +91,48 @@ def job_function():
 # cross-launch resources to use for the bot, otherwise initialize to None
 if cico_common.meraki_dashboard_support():
     print("Attempting to resolve Dashboard references...")
-    dbmap = meraki_dashboard_link_parser.get_meraki_http_info()
-    cico_meraki.meraki_dashboard_map = dbmap
+    dbmap = meraki_dashboard_link_parser.get_meraki_dashboard_map()
+    cico_meraki.set_meraki_dashboard_map(dbmap)
     print("Dbmap=", dbmap)
 else:
-    cico_meraki.meraki_dashboard_map = None
+    cico_meraki.set_meraki_dashboard_map(None)
 
 
-# If the Umbrella environment variables (aka Amazon S3) have been configured, enable the job scheduler to run every
-# 5 minutes to download logs.
-if cico_common.umbrella_support():
+# If the Umbrella environment variables (aka Amazon S3) or the Meraki environment variables have been configured,
+# enable the job scheduler to run background jobs.
+if cico_common.umbrella_support() or cico_common.meraki_support():
     cron = BackgroundScheduler()
 
     # Explicitly kick off the background thread
     cron.start()
+
+    # Shutdown your cron thread if the web process is stopped
+    atexit.register(lambda: cron.shutdown(wait=False))
+
+# If the Umbrella environment variables (aka Amazon S3) have been configured, run a job every 5 minutes to download
+# logs.
+if cico_common.umbrella_support():
     job = cron.add_job(job_function, 'interval', minutes=5)
     print("Beginning Umbrella Log Collection...")
     job_function()
 
-    # Shutdown your cron thread if the web process is stopped
-    atexit.register(lambda: cron.shutdown(wait=False))
+# If the Meraki environment variables have been configured, keep the Meraki snapshot cache warm so that health
+# commands can be answered from memory.
+if cico_common.meraki_support():
+    cron.add_job(cico_meraki.refresh_meraki_cache, 'interval', seconds=int(meraki_cache.meraki_cache_refresh),
+                 next_run_time=datetime.datetime.now())
+    # Clients, Systems Manager devices and uplinks take much longer to fetch, so they have their own job; otherwise a
+    # long fan-out would hold up the device statuses
+    cron.add_job(cico_meraki.refresh_meraki_slow_cache, 'interval', seconds=int(meraki_cache.meraki_cache_refresh),
+                 next_run_time=datetime.datetime.now())
+    meraki_cache.refresher_active = True
+    print("Beginning Meraki Cache Refresh...")
+
+# If a dashboard username and password has been provided, periodically check for new networks and devices that do not
+# have a cross-launch link yet.
+if cico_common.meraki_support() and cico_common.meraki_dashboard_support():
+    cron.add_job(meraki_dashboard_link_parser.reconcile_dashboard_map, 'interval',
+                 seconds=int(meraki_dashboard_link_parser.meraki_dashboard_reconcile))
 
 # ========================================================
 # Initialize Bot - Register commands and start web server
@@ -117,6 +142,10 @@ if cico_common.umbrella_support():
 bot = SparkBot(bot_app_name, spark_bot_token=spark_token,
                spark_bot_url=bot_url, spark_bot_email=bot_email, default_action="help", debug=True)
 
+# If a Meraki webhook shared secret has been provided, accept device alerts from the dashboard on the bot's web server.
+if cico_common.meraki_webhook_support():
+    meraki_webhook_receiver.register_webhook(bot)
+
 bot.add_command('help', 'Get help.', bot.send_help)
 bot.remove_command('/echo')
 bot.remove_command('/help')
@@ -124,8 +153,10 @@ bot.remove_command('/help')
 # Add bot commands.
 # If Meraki environment variables have been enabled, add Meraki-specifc commands.
 if cico_common.meraki_support():
-    bot.add_command('meraki-health', 'Get health of Meraki environment.', cico_meraki.get_meraki_health_html)
+    bot.add_command('meraki-health', 'Get health of Meraki environment. Optionally add a network name or "offline", and "page <n>".', cico_meraki.get_meraki_health_html)
     bot.add_command('meraki-check', 'Check Meraki user status.', cico_meraki.get_meraki_clients_html)
+    bot.add_command('meraki-trend', 'Get Meraki offline time and flaps over the recent past. Optionally add a network name.', cico_meraki.get_meraki_trend_html)
+    bot.add_command('meraki-api-stats', 'Get Meraki API request scheduler statistics.', cico_meraki.get_meraki_api_stats_html)
 # If Spark Call environment variables have been enabled, add Spark Call-specifc commands.
 if cico_common.spark_call_support():
     bot.add_command('spark-health', 'Get health of Spark environment.', cico_spark_call.get_spark_call_health_html)
@@ -1,6 +1,7 @@
 import requests
 import os
 import json
+import cico_common
 
 
 a4e_client_id = os.getenv("A4E_CLIENT_ID")
@@ -52,8 +53,7 @@ def get_a4e_health(incoming_msg, rettype):
 
 
 def get_a4e_clients(incoming_msg, rettype):
-    cmdlist = incoming_msg.text.split(" ")
-    client_id = cmdlist[len(cmdlist)-1]
+    client_id = cico_common.get_client_id(incoming_msg)
 
     evjson = get_a4e_events()
     totalevents = evjson["metadata"]["results"]["current_item_count"]
@@ -2,21 +2,13 @@
     This module is specifically for interoperability between the various individual modules. Any generic product code
     should be placed into a product specific module, and any relevant integration should be added here.
 '''
-import os
 import cico_meraki
 import cico_spark_call
 import cico_umbrella
 import cico_a4e
 import cico_common
-
-# ========================================================
-# Load required parameters from environment variables
-# ========================================================
-
-meraki_client_to = os.getenv("MERAKI_CLIENT_TIMESPAN")
-if not meraki_client_to:
-    meraki_client_to = "86400"
-
+import meraki_sm_catalog
+import meraki_client_index
 
 # ========================================================
 # Initialize Program - Function Definitions
@@ -77,26 +69,26 @@ def get_clients(incoming_msg):
     uclients = {}
     aclients = {}
     netlist = []
-    newsmlist = []
-    smnetid = ""
+    newsmlist = {}
+    ports = {}
 
     # Parse incoming message in order to retrieve the username of the client
-    cmdlist = incoming_msg.text.split(" ")
-    client_id = cmdlist[len(cmdlist)-1]
+    client_id = cico_common.get_client_id(incoming_msg)
 
-    # If Meraki environment variables have been enabled, retrieve Meraki client information
-    if cico_common.meraki_support():
-        print("Meraki Support Enabled")
-        # cico_spark_call.get_spark_call_clients_html(incoming_msg)
-        mclients = cico_meraki.get_meraki_clients(incoming_msg, "json")
-        netlist = mclients["client"]            # Dashboard Clients
-        newsmlist = mclients["sm"]              # Systems Manager Clients
-        smnetid = mclients["smnetid"]        # Systems Manager Clients
     # If Spark Call environment variables have been enabled, retrieve Spark Call client information
     if cico_common.spark_call_support():
         print("Spark Call Support Enabled")
         # cico_meraki.get_meraki_clients_html(incoming_msg)
         sclients = cico_spark_call.get_spark_call_clients(incoming_msg, "json")
+    # If Meraki environment variables have been enabled, retrieve Meraki client information. Spark Call is queried
+    # first so that the user's phones can be located along with the user.
+    if cico_common.meraki_support():
+        print("Meraki Support Enabled")
+        # cico_spark_call.get_spark_call_clients_html(incoming_msg)
+        mclients = cico_meraki.get_meraki_clients(incoming_msg, "json", list(sclients.get("phones", {})))
+        netlist = mclients["client"]            # Dashboard Clients
+        newsmlist = mclients["sm"]              # Systems Manager Clients
+        ports = mclients["ports"]               # Switch Port Statuses
     # If Umbrella (S3) environment variables have been enabled, retrieve Umbrella client information
     if cico_common.umbrella_support():
         print("Umbrella Support Enabled")
@@ -121,33 +113,29 @@ def get_clients(incoming_msg):
                 for cli in netlist[net]["devices"][dev]["clients"]:
                     # The client should not be a string. If it is for some reason, do not process it.
                     if not isinstance(cli, str):
-                        # If the description of the client matches the username specified in Spark, and if this specific
-                        # client has a switchport mapping, then continue (duplicate clients from MX security appliances
-                        # will also be in this list, the switchport check is used to exclude those)
-                        if cli["description"] == client_id and "switchport" in cli and cli["switchport"] is not None:
+                        # If the description of the client matches the username specified in Spark (or the client
+                        # matches the IP address / CIDR range / MAC prefix specified), and if this specific client has a
+                        # switchport mapping, then continue (duplicate clients from MX security appliances will also be
+                        # in this list, the switchport check is used to exclude those)
+                        if meraki_client_index.client_query_matches(cli, client_id) and "switchport" in cli and cli["switchport"] is not None:
                             devbase = netlist[net]["devices"][dev]["info"]
                             # These functions generate the cross-launch links (if available) for the given
                             # client/device/port
-                            showdev = cico_meraki.meraki_create_dashboard_link("devices", devbase["mac"], devbase["name"], "?timespan=" + meraki_client_to, 0)
-                            showport = cico_meraki.meraki_create_dashboard_link("devices", devbase["mac"], str(cli["switchport"]), "/ports/" + str(cli["switchport"]) + "?timespan=" + meraki_client_to, 1)
-                            showcli = cico_meraki.meraki_dashboard_client_mod(showdev, cli["id"], cli["dhcpHostname"])
+                            showdev, showport, showcli = cico_meraki.meraki_dashboard_device_links(devbase["mac"], devbase["name"], str(cli["switchport"]), cli["id"], cli["dhcpHostname"])
                             if devcount > 0:
                                 retm += "<br>"
                             devcount += 1
                             retm += "<i>Computer Name:</i> " + showcli + "<br>"
 
-                            # Iterate the Systems Manager list to see if the client exists there. Iterate through networks.
-                            if net in newsmlist:
-                                # If this network has any devices, then we will attempt to cross reference the client data
-                                if "devices" in newsmlist[net]:
-                                    # Our cross-reference point is mac address, as it will exist in both the dashboard
-                                    # clients list as well as the systems manager clients list.
-                                    if cli["mac"] in newsmlist[net]["devices"]:
-                                        # If we are able to cross-reference, we will add some system-specific and
-                                        # OS-specific details from SM
-                                        smbase = newsmlist[net]["devices"][cli["mac"]]
-                                        retm += "<i>Model:</i> " + smbase["systemModel"] + "<br>"
-                                        retm += "<i>OS:</i> " + smbase["osName"] + "<br>"
+                            # Look the client up in the Systems Manager catalog. Our cross-reference point is mac
+                            # address, as it will exist in both the dashboard clients list as well as the systems
+                            # manager clients list.
+                            smbase = meraki_sm_catalog.lookup_sm_mac(newsmlist, cli["mac"])
+                            if smbase:
+                                # If we are able to cross-reference, we will add some system-specific and
+                                # OS-specific details from SM
+                                retm += "<i>Model:</i> " + smbase["systemModel"] + "<br>"
+                                retm += "<i>OS:</i> " + smbase["osName"] + "<br>"
 
                             # Once we've checked for Systems Manager cross references, we will display the rest of the
                             # client details
@@ -157,6 +145,7 @@ def get_clients(incoming_msg):
                             # This creates the description of the switch / port the client is connected to
                             # --duplicate-- devbase = netlist[net]["devices"][dev]["info"]
                             retm += "<i>Connected To:</i> " + showdev + " (" + devbase["model"] + "), Port " + showport + "<br>"
+                            retm += cico_meraki.format_port_status(ports, dev, cli["switchport"])
 
                             # Now, check to see if there is cooresponding Amp for Endpoints data...
                             if cico_common.a4e_support():
@@ -190,9 +179,7 @@ def get_clients(incoming_msg):
                             devbase = netlist[net]["devices"][dev]["info"]
                             # These functions generate the cross-launch links (if available) for the given
                             # client/device/port
-                            showdev = cico_meraki.meraki_create_dashboard_link("devices", devbase["mac"], devbase["name"], "?timespan=" + meraki_client_to, 0)
-                            showport = cico_meraki.meraki_create_dashboard_link("devices", devbase["mac"], str(cli["switchport"]), "/ports/" + str(cli["switchport"]) + "?timespan=" + meraki_client_to, 1)
-                            showcli = cico_meraki.meraki_dashboard_client_mod(showdev, cli["id"], cli["dhcpHostname"])
+                            showdev, showport, showcli = cico_meraki.meraki_dashboard_device_links(devbase["mac"], devbase["name"], str(cli["switchport"]), cli["id"], cli["dhcpHostname"])
 
                             # No Systems Manager references here, but we will add the cross-referened data for the phone
                             # itself, like it's mac address, description, and whether it is registered.
@@ -204,21 +191,21 @@ def get_clients(incoming_msg):
                             retsc += "<i>VLAN:</i> " + str(cli["vlan"]) + "<br>"
                             # This creates the description of the switch / port the client is connected to
                             retsc += "<i>Connected To:</i> " + showdev + " (" + devbase["model"] + "), Port " + showport + "<br>"
-    elif newsmlist:
-        for cli in newsmlist[smnetid]["devices"]:
-            smbase = newsmlist[smnetid]["devices"][cli]
-            if client_id.lower() in smbase["name"].lower() or client_id.lower() in [x.lower() for x in smbase["tags"]]:
-                if devcount > 0:
-                    retm += "<br>"
-                devcount += 1
-                retm += "<i>Client Name:</i> " + smbase["name"] + "<br>"
-                retm += "<i>Model:</i> " + smbase["systemModel"] + "<br>"
-                retm += "<i>OS:</i> " + smbase["osName"] + "<br>"
-                retm += "<i>MAC:</i> " + smbase["wifiMac"] + "<br>"
-                smssid = smbase["ssid"]
-                if smssid is None:
-                    smssid = "N/A"
-                retm += "<i>Wireless SSID:</i> " + smssid + "<br>"
+                            retsc += cico_meraki.format_port_status(ports, dev, cli["switchport"])
+    elif newsmlist and newsmlist["entries"]:
+        # Search the Systems Manager catalog by name and tag
+        for smbase in meraki_sm_catalog.search_sm_catalog(newsmlist, client_id):
+            if devcount > 0:
+                retm += "<br>"
+            devcount += 1
+            retm += "<i>Client Name:</i> " + smbase["name"] + "<br>"
+            retm += "<i>Model:</i> " + smbase["systemModel"] + "<br>"
+            retm += "<i>OS:</i> " + smbase["osName"] + "<br>"
+            retm += "<i>MAC:</i> " + smbase["wifiMac"] + "<br>"
+            smssid = smbase["ssid"]
+            if smssid is None:
+                smssid = "N/A"
+            retm += "<i>Wireless SSID:</i> " + smssid + "<br>"
 
     # If there are phone numbers defined in the Spark Call clients list, we want to add that to the output as well.
     if "numbers" in sclients:
@@ -13,6 +13,7 @@ meraki_api_token = os.getenv("MERAKI_API_TOKEN")
 meraki_org = os.getenv("MERAKI_ORG")
 meraki_http_username = os.getenv("MERAKI_HTTP_USERNAME")
 meraki_http_password = os.getenv("MERAKI_HTTP_PASSWORD")
+meraki_webhook_secret = os.getenv("MERAKI_WEBHOOK_SECRET")
 spark_api_token = os.getenv("SPARK_API_TOKEN")
 s3_bucket = os.getenv("S3_BUCKET")
 s3_key = os.getenv("S3_ACCESS_KEY_ID")
@@ -26,6 +27,20 @@ a4e_client_secret = os.getenv("A4E_CLIENT_SECRET")
 # ========================================================
 
 
+def get_client_id(incoming_msg):
+    '''
+    Returns the client (username) a check command is for: the last word of the message, leaving out any 'org:' option
+    (used to pick the Meraki organization in multi-organization mode)
+
+    :param incoming_msg: String. this is the message that is posted in Spark
+    :return: String. The client username, or "" if there is none
+    '''
+    cmdlist = [cmd for cmd in incoming_msg.text.split(" ") if not cmd.lower().startswith("org:")]
+    if not cmdlist:
+        return ""
+    return cmdlist[len(cmdlist)-1]
+
+
 def meraki_support():
     '''
     This function is used to check whether the Meraki environment variables have been set. It will return true
@@ -53,6 +68,20 @@ def meraki_dashboard_support():
         return False
 
 
+def meraki_webhook_support():
+    '''
+    This function is used to check whether the Meraki webhook environment variables have been set. It will return true
+    if they have and false if they have not. These variables are optional, and are used to receive device alerts from
+    the dashboard instead of waiting for the next device status poll
+
+    :return: true/false based on whether or not Meraki webhook support is available
+    '''
+    if meraki_api_token and meraki_webhook_secret:
+        return True
+    else:
+        return False
+
+
 def spark_call_support():
     '''
     This function is used to check whether the Spark Call environment variables have been set. It will return true
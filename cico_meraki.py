@@ -3,17 +3,20 @@
 '''
 
 import requests
-# There are some complications with Python 3.6 and various modules. We will need to monkey-patch some stuff to make
-# it work. Details were found here: https://github.com/kennethreitz/grequests/issues/103
-from gevent import monkey
-def stub(*args, **kwargs):  # pylint: disable=unused-argument
-    pass
-monkey.patch_all = stub
-import grequests
 import os
 import json
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+import time
+import hashlib
+import threading
+import concurrent.futures
+import meraki_cache
+import meraki_client_index
+import meraki_client_store
+import meraki_sm_catalog
+import meraki_api_scheduler
+import meraki_trend_store
+import meraki_records
+import cico_common
 
 # ========================================================
 # Load required parameters from environment variables
@@ -22,30 +25,109 @@ from urllib3.util.retry import Retry
 meraki_client_to = os.getenv("MERAKI_CLIENT_TIMESPAN")
 if not meraki_client_to:
     meraki_client_to = "86400"
+meraki_health_page_size = os.getenv("MERAKI_HEALTH_PAGE_SIZE")
+if not meraki_health_page_size:
+    meraki_health_page_size = "50"
+meraki_client_min_to = os.getenv("MERAKI_CLIENT_MIN_TIMESPAN")
+meraki_client_fetch_mode = os.getenv("MERAKI_CLIENT_FETCH_MODE")
+if not meraki_client_fetch_mode:
+    meraki_client_fetch_mode = "device"
+meraki_uplink_batch = os.getenv("MERAKI_UPLINK_BATCH")
+if not meraki_uplink_batch:
+    meraki_uplink_batch = "20"
+meraki_port_status_ttl = os.getenv("MERAKI_PORT_STATUS_TTL")
+if not meraki_port_status_ttl:
+    meraki_port_status_ttl = "60"
 meraki_api_token = os.getenv("MERAKI_API_TOKEN")
 meraki_over_dash = os.getenv("MERAKI_OVERRIDE_DASHBOARD")
+meraki_org = os.getenv("MERAKI_ORG")
+meraki_org_file = os.getenv("MERAKI_ORG_CACHE_FILE")
+# Comma separated list of organization ids, or 'all' for every organization the API key has access to. Enables
+# multi-organization mode.
+meraki_org_list = os.getenv("MERAKI_ORGS")
 #meraki_dashboard_map = os.getenv("MERAKI_DASHBOARD_MAP")       -- removed: enabled link generation at run-time --
+meraki_dashboard_map = None
+# Cross-launch link prefixes built from meraki_dashboard_map, see set_meraki_dashboard_map
+meraki_dashboard_links = {"networks": {}, "devices": {}}
 header = {"X-Cisco-Meraki-API-Key": meraki_api_token}
+# List of organizations, retrieved once per process by get_meraki_orgs
+meraki_orgs = None
+org_lock = threading.RLock()
+# The organization the current thread is working on, in multi-organization mode (see run_for_org)
+org_context = threading.local()
+# Switch port statuses fetched for user checks, keyed by serial: {"updated": time, "ports": {portId: status}}
+port_status_cache = {}
+port_status_lock = threading.Lock()
 
 # ========================================================
 # Initialize Program - Function Definitions
 # ========================================================
 
 
+class MerakiAPIError(Exception):
+    '''
+    Raised when a Dashboard API list could not be retrieved, so that a cache tier keeps its previous data rather than
+    being replaced with an empty list
+    '''
+    pass
+
+
+def iter_meraki_pages(url, errlabel, priority=meraki_api_scheduler.PRIORITY_INTERACTIVE, org=None):
+    '''
+    Issues a GET request for a Dashboard API list endpoint, following the Link headers to any further pages. Records
+    are yielded one at a time, and each page is released before the next one is requested, so the caller can process
+    records as they arrive without holding a copy of every page.
+
+    :param url: String. URL of the first page
+    :param errlabel: String. Description of what is being retrieved, used in error messages
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :param org: String. (optional) organization id used for rate limiting. Defaults to the specified/derived org.
+    :return: Generator. Each record from each page. Raises MerakiAPIError if any page could not be retrieved, so a
+             partial list is never taken for the whole list.
+    '''
+    if org is None:
+        org = get_meraki_org()
+    while url:
+        resp = meraki_api_scheduler.get(url, header, org, priority)
+        if resp is None:
+            raise MerakiAPIError("Error retrieving " + errlabel + ": no response")
+        if resp.status_code != 200:
+            raise MerakiAPIError("Error retrieving " + errlabel + ": " + str(resp.status_code))
+        # Work out where the next page is before parsing this one, so the response can be dropped
+        url = resp.links.get("next", {}).get("url")
+        pagestr = resp.content.decode("utf-8")
+        del resp
+        if pagestr.strip() == "":
+            return
+        page = json.loads(pagestr)
+        del pagestr
+        # Hand the records back one at a time, and release them from the page as we go
+        page.reverse()
+        while page:
+            yield page.pop()
+
+
 def get_meraki_orgs():
     '''
-    Get a list of all organizations the user has access to
+    Get a list of all organizations the user has access to. The list is only retrieved once per process.
 
     :return: a list of dictionaries with all organizations
     '''
-    url = "https://dashboard.meraki.com/api/v0/organizations"
-    netlist = requests.get(url, headers=header)
-    netstr = netlist.content.decode("utf-8")
-    if netstr.strip() != "":
-        orgjson = json.loads(netstr)
-    else:
-        orgjson = {}
-    return orgjson
+    global meraki_orgs
+    with org_lock:
+        if meraki_orgs is None:
+            # This is not tied to a single organization, so it is rate limited on its own
+            try:
+                orglist = list(iter_meraki_pages("https://dashboard.meraki.com/api/v0/organizations",
+                                                 "Meraki organizations", meraki_api_scheduler.PRIORITY_INTERACTIVE, ""))
+            except MerakiAPIError as e:
+                print(e)
+                orglist = []
+            # Don't remember an empty list; it most likely means the request failed
+            if not orglist:
+                return orglist
+            meraki_orgs = orglist
+    return meraki_orgs
 
 
 def get_meraki_one_org():
@@ -78,80 +160,709 @@ def get_meraki_one_org():
         return "none"
 
 
-# ========================================================
-# Delayed parameter load for the organization
-# ========================================================
-meraki_org = os.getenv("MERAKI_ORG")
-if not meraki_org:
-    meraki_org = get_meraki_one_org()
-# ========================================================
+def get_org_file_key():
+    '''
+    The organization cache file is only valid for the API key it was written with. This returns a hash of the API key
+    that is stored alongside the organization.
+
+    :return: String. Hash of the API key
+    '''
+    return hashlib.sha256(str(meraki_api_token).encode("utf-8")).hexdigest()
 
 
-def get_meraki_networks():
+def load_org_file():
     '''
-    Get a list of all networks associated with the specified organization. Watch for 200 OK, because an organization
-    can have 0 networks, which will generate a 404 instead.
+    Load the organization that was selected by a previous run, if MERAKI_ORG_CACHE_FILE has been set
 
-    :return: a dictionary with all networks that are part of the specified/derived organization
+    :return: Dictionary. The organization id and name, or None if there is no usable cache file
     '''
-    url = "https://dashboard.meraki.com/api/v0/organizations/" + meraki_org + "/networks"
-    netlist = requests.get(url, headers=header)
-    if netlist.status_code == 200:
-        netjson = json.loads(netlist.content.decode("utf-8"))
-    else:
-        netjson = {}
-        print("Error retrieving Meraki networks:", netlist.status_code)
-    return netjson
+    if not meraki_org_file:
+        return None
+    try:
+        with open(meraki_org_file) as f:
+            orgjson = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if orgjson.get("key") != get_org_file_key():
+        return None
+    return orgjson
 
 
-def get_org_devices(netinfo):
+def save_org_file(orgid, orgname):
     '''
-    Get a list of all devices in a given organization
+    Save the selected organization, if MERAKI_ORG_CACHE_FILE has been set, so the next run does not have to look it up
 
-    :return: a list with all devices that are part of the specified/derived organization
+    :param orgid: String. Organization id
+    :param orgname: String. Organization name
+    :return: Nothing
     '''
-    url = "https://dashboard.meraki.com/api/v0/organizations/" + meraki_org + "/devices"
-    netlist = requests.get(url, headers=header)
-    if netlist.status_code == 200:
-        netjson = json.loads(netlist.content.decode("utf-8"))
-    else:
-        netjson = {}
-        print("Error retrieving Meraki devices:", netlist.status_code)
-    return netjson
+    if not meraki_org_file:
+        return
+    try:
+        with open(meraki_org_file, "w") as f:
+            json.dump({"key": get_org_file_key(), "id": orgid, "name": orgname}, f)
+    except IOError as e:
+        print("Unable to save Meraki organization to", meraki_org_file, e)
+
+
+def get_meraki_org():
+    '''
+    Returns the organization id to use. If MERAKI_ORG was not provided, the organization is selected the first time it
+    is needed (see get_meraki_one_org), and remembered for the rest of the process (and, optionally, across restarts).
+    This means importing this module does not make any Dashboard API calls. In multi-organization mode, the
+    organization set by run_for_org is used instead.
+
+    :return: a string with the organization id, or 'none' if there was a problem
+    '''
+    global meraki_org
+    # In multi-organization mode, use the organization the current thread is working on
+    ctxorg = getattr(org_context, "org", None)
+    if ctxorg:
+        return ctxorg
+    if meraki_org:
+        return meraki_org
+
+    with org_lock:
+        # Another thread may have selected the organization while we were waiting
+        if meraki_org:
+            return meraki_org
+
+        orgjson = load_org_file()
+        if orgjson:
+            print("Using Meraki organization from " + meraki_org_file + ", id #", orgjson["id"])
+            meraki_org = orgjson["id"]
+            return meraki_org
+
+        thisorg = get_meraki_one_org()
+        if thisorg == "none":
+            # Don't remember a failure; try again next time
+            return thisorg
+        meraki_org = thisorg
+        save_org_file(meraki_org, get_meraki_org_name())
+    return meraki_org
+
+
+def get_meraki_org_name():
+    '''
+    Returns the name of the organization in use, from the cache file or the (once per process) list of organizations
+
+    :return: String. The organization name for the specified/derived organization.
+    '''
+    orgid = get_meraki_org()
+    orgjson = load_org_file()
+    if orgjson and str(orgjson["id"]) == str(orgid):
+        return orgjson["name"]
+
+    orgname = ""
+    for n in get_meraki_orgs():
+        if str(n["id"]) == str(orgid):
+            orgname = n["name"]
+    return orgname
+
+
+def get_meraki_org_list():
+    '''
+    Returns the organizations to work with. In multi-organization mode this is MERAKI_ORGS (or every organization the
+    API key has access to, for 'all'); otherwise it is just the specified/derived organization.
+
+    :return: List. Organization ids
+    '''
+    if not meraki_org_list:
+        return [get_meraki_org()]
+    if meraki_org_list.strip().lower() == "all":
+        return [str(o["id"]) for o in get_meraki_orgs()]
+    return [o.strip() for o in meraki_org_list.split(",") if o.strip()]
+
+
+def get_meraki_org_names():
+    '''
+    Returns the name of each organization the API key has access to
+
+    :return: Dictionary. Organization names, keyed by organization id
+    '''
+    orgnames = {}
+    for o in get_meraki_orgs():
+        orgnames[str(o["id"])] = o["name"]
+    return orgnames
+
+
+def run_for_org(org, func, *args):
+    '''
+    Runs a function on behalf of an organization. Anything it calls that uses get_meraki_org (API URLs, rate limiting,
+    cache tiers) will use this organization.
+
+    :param org: String. Organization id, or None to use the specified/derived organization
+    :param func: Function. The function to run
+    :param args: Arguments for the function
+    :return: The result of the function
+    '''
+    if org is None:
+        return func(*args)
+    prevorg = getattr(org_context, "org", None)
+    org_context.org = org
+    try:
+        return func(*args)
+    finally:
+        org_context.org = prevorg
+
+
+def run_across_orgs(orgs, func, *args):
+    '''
+    Runs a function for each organization, in parallel when there is more than one
+
+    :param orgs: List. Organization ids (or [None] for the specified/derived organization)
+    :param func: Function. The function to run
+    :param args: Arguments for the function
+    :return: List. The result for each organization, in the same order as orgs
+    '''
+    if len(orgs) <= 1:
+        return [run_for_org(org, func, *args) for org in orgs]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(orgs)) as pool:
+        futures = [pool.submit(run_for_org, org, func, *args) for org in orgs]
+        return [f.result() for f in futures]
 
 
-def get_org_device_statuses(netinfo):
+def get_target_orgs(incoming_msg):
     '''
-    Get a list of all devices/statuses in a given organization
+    Works out which organizations a command applies to. In multi-organization mode, a command can be limited to one
+    organization with 'org:<id or name>'; otherwise it applies to all of them.
 
+    :param incoming_msg: String. this is the message that is posted in Spark
+    :return: List. Organization ids, or [None] when not in multi-organization mode
+    '''
+    if not meraki_org_list:
+        return [None]
+    orgs = get_meraki_org_list()
+    for cmd in incoming_msg.text.split():
+        if cmd.lower().startswith("org:"):
+            orgval = cmd[4:].lower()
+            orgnames = get_meraki_org_names()
+            return [o for o in orgs if o.lower() == orgval or orgnames.get(o, "").lower() == orgval]
+    return orgs
+
+
+def org_tier(tiername):
+    '''
+    Returns the name of a cache tier for the organization the current thread is working on. In multi-organization
+    mode, each organization has its own set of tiers, which are registered the first time they are needed.
+
+    :param tiername: String. Name of the tier, eg 'networks'
+    :return: String. Name of the tier to use with meraki_cache
+    '''
+    if not meraki_org_list:
+        return tiername
+    org = get_meraki_org()
+    orgtier = meraki_cache.org_tier_name(tiername, org)
+    if orgtier not in meraki_cache.cache_tiers:
+        with org_lock:
+            if orgtier not in meraki_cache.cache_tiers:
+                register_org_tiers(org)
+    return orgtier
+
+
+def get_refresh_orgs():
+    '''
+    Returns the organizations the background refresher works on. In multi-organization mode, makes sure every
+    organization has its cache tiers.
+
+    :return: List. Organization ids, or [None] in single organization mode
+    '''
+    if not meraki_org_list:
+        return [None]
+    orgs = get_meraki_org_list()
+    for org in orgs:
+        run_for_org(org, org_tier, "networks")
+    return orgs
+
+
+def refresh_meraki_slow_cache():
+    '''
+    Entry point for the background refresher of the slow tiers (clients, Systems Manager devices and uplinks). These
+    fan out to every device or network, so they run in their own job and do not hold up refresh_meraki_cache.
+
+    :return: Nothing
+    '''
+    get_refresh_orgs()
+    meraki_cache.refresh_stale_tiers(True)
+
+
+def refresh_meraki_cache():
+    '''
+    Entry point for the background refresher. In multi-organization mode, makes sure every organization has its cache
+    tiers, then refreshes whatever is stale (each organization in parallel), apart from the slow tiers (see
+    refresh_meraki_slow_cache). Finally, records a health trend sample.
+
+    :return: Nothing
+    '''
+    orgs = get_refresh_orgs()
+    meraki_cache.refresh_stale_tiers()
+    # Record a health trend sample from any statuses that changed
+    for org in orgs:
+        run_for_org(org, record_org_trend)
+
+
+def record_org_trend():
+    '''
+    Records the current device statuses of an organization into the trend store. Nothing is recorded if the statuses
+    have not changed since the last sample.
+
+    :return: Nothing
+    '''
+    statuses = meraki_cache.peek_tier(org_tier("statuses"))
+    inventory = meraki_cache.peek_tier(org_tier("inventory"))
+    if statuses is None or inventory is None:
+        return
+
+    netstatus = {}
+    for stat in statuses.values():
+        netname = inventory["split_names"].get(stat["serial"])
+        if netname:
+            if netname not in netstatus:
+                netstatus[netname] = {}
+            netstatus[netname][stat["serial"]] = stat.get("status") != "online"
+    meraki_trend_store.record_sample(get_meraki_org(), time.time(), netstatus,
+                                     meraki_cache.get_tier_version(org_tier("statuses")))
+
+
+def get_meraki_networks(priority=meraki_api_scheduler.PRIORITY_INTERACTIVE):
+    '''
+    Get a list of all networks associated with the specified organization. Anything other than 200 OK (including the
+    404 returned for an organization with 0 networks) raises MerakiAPIError, so a previously cached list is kept.
+
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :return: a list with all networks that are part of the specified/derived organization
+    '''
+    url = "https://dashboard.meraki.com/api/v0/organizations/" + get_meraki_org() + "/networks"
+    return list(iter_meraki_pages(url, "Meraki networks", priority))
+
+
+def get_org_devices(netinfo, priority=meraki_api_scheduler.PRIORITY_INTERACTIVE):
+    '''
+    Get all devices in a given organization. The devices are indexed by serial number as they arrive, and only the
+    fields the bot uses are kept (see meraki_records.DeviceRecord).
+
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :return: a dictionary with all devices that are part of the specified/derived organization, keyed by serial
+    '''
+    url = "https://dashboard.meraki.com/api/v0/organizations/" + get_meraki_org() + "/devices?perPage=1000"
+    devdict = {}
+    for dev in iter_meraki_pages(url, "Meraki devices", priority):
+        devdict[dev["serial"]] = meraki_records.DeviceRecord(dev)
+    return devdict
+
+
+def get_org_statuses(priority=meraki_api_scheduler.PRIORITY_INTERACTIVE):
+    '''
+    Get the current status of all devices in a given organization. The statuses are indexed by serial number as they
+    arrive, and only the fields the bot uses are kept (see meraki_records.DeviceRecord).
+
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :return: a dictionary with the status of all devices that are part of the specified/derived organization, keyed
+             by serial
+    '''
+    url = "https://dashboard.meraki.com/api/v0/organizations/" + get_meraki_org() + "/deviceStatuses"
+    statdict = {}
+    for stat in iter_meraki_pages(url, "Meraki device statuses", priority):
+        statdict[stat["serial"]] = meraki_records.DeviceRecord(stat)
+    return statdict
+
+
+def get_org_device_statuses(inventory):
+    '''
+    Get a list of all devices/statuses in a given organization. Statuses are read from the snapshot cache, and grouped
+    by network using the indexes in the organization inventory. The cached status records are used as-is (not copied);
+    the rest of the device data can be found in the inventory by serial.
+
+    :param inventory: Dictionary. Organization inventory from build_org_inventory
     :return: a list with all devices that are part of the specified/derived organization
     '''
-    dev_list = get_org_devices(netinfo)
     out_netjson = {}
-    url = "https://dashboard.meraki.com/api/v0/organizations/" + meraki_org + "/deviceStatuses"
-    netlist = requests.get(url, headers=header)
-    if netlist.status_code == 200:
-        netjson = json.loads(netlist.content.decode("utf-8"))
-        for n in netjson:
-            dev_info = {}
-            for d in dev_list:
-                if d["serial"] == n["serial"]:
-                    dev_info = d
-                    break
-            n_info = n
-            n_info["info"] = dev_info
-            if n["networkId"] in out_netjson:
-                out_netjson[n["networkId"]]["devices"][n["serial"]] = n_info
-            else:
-                out_netjson[n["networkId"]] = {"devices": {n["serial"]: n_info}}
+    netjson = meraki_cache.get_tier(org_tier("statuses"))
+    for n in netjson.values():
+        if n["networkId"] in out_netjson:
+            out_netjson[n["networkId"]]["devices"][n["serial"]] = n
+        elif n["networkId"] in inventory["networks"]:
+            out_netjson[n["networkId"]] = {"info": inventory["networks"][n["networkId"]],
+                                           "devices": {n["serial"]: n}}
+    return out_netjson
+
 
-        for n in out_netjson:
-            for m in netinfo:
-                if m["id"] == n:
-                    out_netjson[n]["info"] = m
+def build_org_inventory(netinfo, devlist):
+    '''
+    Builds the organization inventory: the networks and devices of the organization, with hash indexes so that joins
+    between them are simple lookups. This is built once each time the network or device tier of the cache is
+    refreshed.
+
+    :param netinfo: List. List of networks from get_meraki_networks
+    :param devlist: Dictionary. Devices from get_org_devices, keyed by serial. This is used as the serial index as-is.
+    :return: Dictionary. networks / network_names / network_devices / devices / macs / split_names indexes
+    '''
+    inventory = {"networks": {}, "network_names": {}, "network_devices": {}, "devices": devlist, "macs": {},
+                 "split_names": {}}
+
+    # Index networks by id and by name
+    for net in netinfo:
+        inventory["networks"][net["id"]] = net
+        inventory["network_names"][net["name"]] = net["id"]
+        inventory["network_devices"][net["id"]] = []
+
+    # Index devices by mac address, and group them by network
+    for dev in devlist.values():
+        inventory["macs"][dev["mac"]] = dev["serial"]
+        if dev["networkId"] in inventory["network_devices"]:
+            inventory["network_devices"][dev["networkId"]].append(dev["serial"])
+            # Work out the dashboard (split) network name for this device now, rather than on every health check
+            inventory["split_names"][dev["serial"]] = split_network_name(inventory["networks"][dev["networkId"]], dev)
+
+    return inventory
+
+
+def get_inventory_netlist(inventory, serials):
+    '''
+    Builds a list of networks, each with its list of devices, from the organization inventory. This is in the same
+    form as the result of a /networks/{id}/devices fan-out, so it can be passed to collect_url_list / do_multi_get.
+
+    :param inventory: Dictionary. Organization inventory from build_org_inventory
+    :param serials: List. (optional) pass None to include every device. Otherwise, only these devices are included.
+    :return: Dictionary. {networkId: {"info": network, "devices": [device, ...]}}
+    '''
+    netlist = {}
+    if serials is None:
+        serials = inventory["devices"]
+    for serial in serials:
+        dev = inventory["devices"].get(serial)
+        if dev and dev["networkId"] in inventory["networks"]:
+            if dev["networkId"] not in netlist:
+                netlist[dev["networkId"]] = {"info": inventory["networks"][dev["networkId"]], "devices": []}
+            netlist[dev["networkId"]]["devices"].append(dev)
+    return netlist
+
+
+def get_network_clients(netlist, spans, priority=meraki_api_scheduler.PRIORITY_INTERACTIVE):
+    '''
+    Get the clients of each network with one /networks/{id}/clients request per network (plus any further pages),
+    rather than one request per device. Each client is attributed to the device it was most recently seen on.
+
+    :param netlist: Dictionary. Networks to poll, from get_inventory_netlist. Every device of each network should be
+                    included, so each device's poll time is updated even if it has no clients.
+    :param spans: Dictionary. Timespan to poll each device for, keyed by serial. Each network is asked for the longest
+                  timespan of its devices, and every device of the network is updated with it.
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :return: Dictionary. Same form as a /devices/{serial}/clients fan-out with do_multi_get:
+             {networkId: {"info": network, "devices": {serial: {"info": device, "clients": [...]}}}}
+    '''
+    clientlist = {}
+    urlnet = []
+    for net in netlist:
+        clientlist[net] = {"info": netlist[net]["info"], "devices": {}}
+        span = 0
+        for dev in netlist[net]["devices"]:
+            clientlist[net]["devices"][dev["serial"]] = {"info": dev, "clients": []}
+            span = max(span, spans[dev["serial"]])
+        for dev in netlist[net]["devices"]:
+            spans[dev["serial"]] = span
+        urlnet.append("https://dashboard.meraki.com/api/v0/networks/" + net + "/clients?perPage=1000&timespan=" + str(span))
+
+    for resp in meraki_api_scheduler.multi_get(urlnet, header, get_meraki_org(), priority):
+        net = resp.url.split("/")[6]
+        netclients = json.loads(resp.content.decode("utf-8"))
+        # Networks with more than one page of clients; fetch the rest of the pages
+        if "next" in resp.links:
+            try:
+                netclients.extend(iter_meraki_pages(resp.links["next"]["url"], "Meraki network clients", priority))
+            except MerakiAPIError as e:
+                # Leave the network out, so its devices keep their last poll time and are asked again next time
+                print(e)
+                del clientlist[net]
+                continue
+        for cli in netclients:
+            devbase = clientlist[net]["devices"].get(cli.get("recentDeviceSerial"))
+            if devbase:
+                # Network clients do not have a separate DHCP hostname; use the description, which defaults to it
+                if "dhcpHostname" not in cli:
+                    cli["dhcpHostname"] = cli.get("description")
+                devbase["clients"].append(cli)
+
+    return clientlist
+
+
+def poll_org_clients(serials, priority=meraki_api_scheduler.PRIORITY_INTERACTIVE):
+    '''
+    Polls devices in the organization for their clients, and merges the result into the client store. Each device is
+    only asked for the clients seen since it was last polled. With MERAKI_CLIENT_FETCH_MODE=network, each network is
+    asked for its clients instead, so the whole network is polled even if only some of its devices were requested.
+
+    :param serials: List. (optional) pass None to poll every device. Otherwise, only these devices are polled.
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :return: Dictionary. The clients of the polled devices, from the client store, in the form
+             {networkId: {"info": ..., "devices": {serial: {"info": device, "clients": [...]}}}}
+    '''
+    inventory = meraki_cache.get_tier(org_tier("inventory"))
+    if inventory is None:
+        raise MerakiAPIError("Meraki inventory is not available")
+    netlist = get_inventory_netlist(inventory, serials)
+    polltime = time.time()
+
+    if meraki_client_fetch_mode == "network":
+        netserials = []
+        for net in netlist:
+            netserials += inventory["network_devices"][net]
+        netlist = get_inventory_netlist(inventory, netserials)
+    # Work out how far back each device needs to be asked for clients
+    spans = {}
+    for net in netlist:
+        for dev in netlist[net]["devices"]:
+            spans[dev["serial"]] = meraki_client_store.get_poll_timespan(get_meraki_org(), dev["serial"], int(meraki_client_to))
+
+    if meraki_client_fetch_mode == "network":
+        clientlist = get_network_clients(netlist, spans, priority)
     else:
-        print("Error retrieving Meraki devices:", netlist.status_code)
-    return out_netjson
+        # Create the URLs needed to get the list of clients. The timespan differs per device.
+        urldev = []
+        for net in netlist:
+            for dev in netlist[net]["devices"]:
+                urldev.append("https://dashboard.meraki.com/api/v0/devices/" + dev["serial"] + "/clients?timespan=" + str(spans[dev["serial"]]))
+        clientlist = do_multi_get(urldev, netlist, "devices", "serial", 6, "", "clients", priority)
+
+    meraki_client_store.merge_clients(get_meraki_org(), clientlist, polltime, spans)
+    meraki_client_store.age_out_clients(get_meraki_org(), int(meraki_client_to), inventory["devices"])
+
+    return meraki_client_store.get_store_netlist(get_meraki_org(), serials)
+
+
+def get_org_sm_catalog(priority=meraki_api_scheduler.PRIORITY_INTERACTIVE):
+    '''
+    Get all Systems Manager devices in the organization, and build the SM device catalog from them
+
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :return: Dictionary. SM device catalog from meraki_sm_catalog.build_sm_catalog
+    '''
+    netjson = meraki_cache.get_tier(org_tier("networks"))
+    # Parse list of networks to extract/create URLs needed to get list of Systems Manager devices
+    smnet = collect_url_list(netjson, "https://dashboard.meraki.com/api/v0/networks/$1/sm/devices/", "id", "", "", "")
+    smlist = do_multi_get(smnet, [], "id", "", 6, "", "", priority)
+    return meraki_sm_catalog.build_sm_catalog(smlist)
+
+
+def is_uplink_device(devinfo):
+    '''
+    Checks whether a device has WAN uplinks (MX security appliances and Z teleworker gateways)
+
+    :param devinfo: Dictionary. The device
+    :return: true/false based on whether the device has WAN uplinks
+    '''
+    model = devinfo.get("model") or ""
+    return decode_model(model) == "appliance" or model.startswith("Z")
+
+
+def get_org_uplinks(priority=meraki_api_scheduler.PRIORITY_INTERACTIVE):
+    '''
+    Get the WAN uplink status of every appliance in the organization. The appliances are requested in rounds of
+    MERAKI_UPLINK_BATCH devices, so a large organization does not fill the request queue in one go. If an appliance
+    could not be retrieved, its previously cached uplinks are kept.
+
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :return: Dictionary. Uplinks of each appliance, keyed by serial
+    '''
+    inventory = meraki_cache.get_tier(org_tier("inventory"))
+    if inventory is None:
+        raise MerakiAPIError("Meraki inventory is not available")
+    serials = [dev["serial"] for dev in inventory["devices"].values() if is_uplink_device(dev)]
+    olduplinks = meraki_cache.peek_tier(org_tier("uplinks")) or {}
+    batchsize = max(1, int(meraki_uplink_batch))
+
+    uplinks = {}
+    for x in range(0, len(serials), batchsize):
+        netlist = get_inventory_netlist(inventory, serials[x:x + batchsize])
+        # Parse list of devices to extract/create URLs needed to get uplink status
+        urlup = collect_url_list(netlist, "https://dashboard.meraki.com/api/v0/networks/$1/devices/$2/uplink", "info", "id", "devices", "serial")
+        uplist = do_multi_get(urlup, netlist, "devices", "serial", 8, "", "uplinks", priority)
+        for net in uplist:
+            for dev in uplist[net]["devices"]:
+                uplinks[dev] = uplist[net]["devices"][dev]["uplinks"]
+
+    for serial in serials:
+        if serial not in uplinks and serial in olduplinks:
+            uplinks[serial] = olduplinks[serial]
+
+    return uplinks
+
+
+def get_uplink_summary(inventory, uplinks, netnames=None):
+    '''
+    Builds the WAN uplink section of the health check from the cached uplink status
+
+    :param inventory: Dictionary. Organization inventory from build_org_inventory
+    :param uplinks: Dictionary. Uplinks of each appliance, keyed by serial, from get_org_uplinks
+    :param netnames: List. (optional) only include the appliances in these dashboard networks (the networks shown by
+                     the health check). Pass None to include every appliance.
+    :return: String. A fully formatted string that is appended to the health check
+    '''
+    if netnames is not None:
+        shown = set(netnames)
+        uplinks = {serial: uplinks[serial] for serial in uplinks if inventory["split_names"].get(serial) in shown}
+    retmsg = "<h3>Meraki WAN Uplinks:</h3><ul>"
+    faildev = 0
+    # Iterate through all of the appliances, sorted by name
+    for serial in sorted(uplinks, key=lambda s: inventory["devices"].get(s, {}).get("name") or s):
+        devinfo = inventory["devices"].get(serial)
+        if not devinfo:
+            continue
+        failed = [up.get("interface", "") for up in uplinks[serial] if str(up.get("status", "")).lower() == "failed"]
+        if failed:
+            faildev += 1
+            showdev = meraki_create_dashboard_link("devices", devinfo["mac"], devinfo.get("name") or serial, "", 0)
+            retmsg += "<li>Appliance '" + showdev + "' has failed uplink(s): " + ", ".join(failed) + chr(0x2757) + chr(0xFE0F) + "</li>"
+    retmsg += "</ul><b>" + str(faildev) + " appliance(s) with a failed uplink out of a total of " + str(len(uplinks)) + " appliance(s)"
+    if netnames is not None:
+        retmsg += " in the network(s) shown"
+    retmsg += ".</b>"
+
+    return retmsg
+
+
+def get_switch_port_statuses(serials, priority=meraki_api_scheduler.PRIORITY_INTERACTIVE):
+    '''
+    Get the port statuses (link, speed, errors, PoE) of a set of switches. Each switch is fetched with a single
+    request for all of its ports, and kept for MERAKI_PORT_STATUS_TTL seconds so that checks made close together share
+    it. Switches that were fetched recently are not asked again.
+
+    :param serials: List. Serial numbers of the switches
+    :param priority: Integer. (optional) request priority, see do_multi_get
+    :return: Dictionary. {serial: {portId: port status}}. Switches that could not be retrieved are left out.
+    '''
+    now = time.time()
+    ports = {}
+    with port_status_lock:
+        for serial in serials:
+            if serial in port_status_cache and now - port_status_cache[serial]["updated"] < int(meraki_port_status_ttl):
+                ports[serial] = port_status_cache[serial]["ports"]
+
+    # Parse list of switches to create URLs needed to get the port statuses that are not cached
+    urlport = ["https://dashboard.meraki.com/api/v0/devices/" + serial + "/switchPortStatuses"
+               for serial in sorted(set(serials)) if serial not in ports]
+    if urlport:
+        portlist = do_multi_get(urlport, [], "", "", 6, "", "ports", priority)
+        with port_status_lock:
+            # Drop anything that has expired, so the cache only holds recently checked switches
+            for serial in [s for s in port_status_cache if now - port_status_cache[s]["updated"] >= int(meraki_port_status_ttl)]:
+                del port_status_cache[serial]
+            for serial in portlist:
+                ports[serial] = {str(port.get("portId")): port for port in portlist[serial]["ports"]}
+                port_status_cache[serial] = {"updated": now, "ports": ports[serial]}
+
+    return ports
+
+
+def format_port_status(ports, serial, switchport):
+    '''
+    Builds the port status line of a user check
+
+    :param ports: Dictionary. Port statuses from get_switch_port_statuses
+    :param serial: String. Serial number of the switch
+    :param switchport: String. The port the client is connected to
+    :return: String. A fully formatted line, or "" if the port status is not known
+    '''
+    port = ports.get(serial, {}).get(str(switchport))
+    if not port:
+        return ""
+
+    portdesc = [port.get("status") or "Unknown"]
+    if port.get("speed"):
+        portdesc.append(port["speed"] + (" " + port["duplex"] + " duplex" if port.get("duplex") else ""))
+    if port.get("powerUsageInWh"):
+        portdesc.append("PoE " + str(port["powerUsageInWh"]) + " Wh")
+    retmsg = "<i>Port Status:</i> " + ", ".join(portdesc)
+    problems = (port.get("errors") or []) + (port.get("warnings") or [])
+    if problems:
+        retmsg += " (" + ", ".join(problems) + ")" + chr(0x2757) + chr(0xFE0F)
+    return retmsg + "<br>"
+
+
+def register_org_tiers(org):
+    '''
+    Registers the snapshot cache tiers for an organization. Nothing is loaded until the first request or background
+    refresh.
+
+    :param org: String. Organization id, or None to register the tiers for the specified/derived organization
+    :return: Nothing
+    '''
+    bg = meraki_api_scheduler.PRIORITY_BACKGROUND
+
+    def tier(tiername):
+        return meraki_cache.org_tier_name(tiername, org)
+
+    def for_org(func, *args):
+        # Loaders run on the background refresher's threads, so they need to be told which organization to use
+        return lambda: run_for_org(org, func, *args)
+
+    meraki_cache.register_tier(tier("networks"), meraki_cache.meraki_cache_network_ttl,
+                               for_org(get_meraki_networks, bg), org)
+    meraki_cache.register_tier(tier("devices"), meraki_cache.meraki_cache_device_ttl,
+                               for_org(get_org_devices, None, bg), org)
+    meraki_cache.register_tier(tier("statuses"), meraki_cache.meraki_cache_status_ttl,
+                               for_org(get_org_statuses, bg), org)
+    meraki_cache.register_derived_tier(tier("inventory"), [tier("networks"), tier("devices")],
+                                       lambda: build_org_inventory(meraki_cache.get_tier(tier("networks")),
+                                                                   meraki_cache.get_tier(tier("devices"))), org)
+    # Systems Manager devices, clients and uplinks need a request per network or device, so they are slow tiers
+    meraki_cache.register_tier(tier("sm"), meraki_cache.meraki_cache_sm_ttl,
+                               for_org(get_org_sm_catalog, bg), org, True)
+    meraki_cache.register_tier(tier("clients"), meraki_cache.meraki_cache_client_ttl,
+                               for_org(poll_org_clients, None, bg), org, True)
+    meraki_cache.register_derived_tier(tier("client_index"), [tier("clients")],
+                                       lambda: meraki_client_index.build_client_index(meraki_cache.get_tier(tier("clients"))), org, True)
+    meraki_cache.register_derived_tier(tier("network_health"), [tier("inventory"), tier("statuses")],
+                                       for_org(lambda: build_network_health(meraki_cache.get_tier(tier("inventory")))), org)
+    meraki_cache.register_tier(tier("uplinks"), meraki_cache.meraki_cache_uplink_ttl,
+                               for_org(get_org_uplinks, bg), org, True)
+
+
+# In single organization mode, the tiers are registered now. In multi-organization mode, each organization's tiers are
+# registered the first time they are needed (see org_tier).
+if not meraki_org_list:
+    register_org_tiers(None)
+
+
+def build_dashboard_links(dbmap):
+    '''
+    Pre-computes the fixed part of every cross-launch link from the dashboard map, so that rendering a client row only
+    has to join cached fragments together.
+
+    :param dbmap: Dictionary. The dashboard map, from meraki_dashboard_link_parser.get_meraki_dashboard_map
+    :return: Dictionary. {"networks": {network name: prefix}, "devices": {mac: {"base": prefix, "device": prefix,
+             "port": prefix, "client": prefix}}}
+    '''
+    links = {"networks": {}, "devices": {}}
+    if not dbmap:
+        return links
+
+    for netname in dbmap.get("networks", {}):
+        links["networks"][netname] = "<a href='" + dbmap["networks"][netname]["baseurl"]
+    for mac in dbmap.get("devices", {}):
+        baseurl = dbmap["devices"][mac]["baseurl"]
+        devlinks = {"base": "<a href='" + baseurl, "device": "<a href='" + baseurl + "?timespan=" + meraki_client_to + "'>",
+                    "port": "<a href='" + baseurl + "/ports/", "client": None}
+        # Client links are on the same dashboard shard/network as the device, under /manage/usage/list
+        if baseurl.find("/manage") >= 0:
+            devlinks["client"] = "<a href='" + baseurl.split("/manage")[0] + "/manage/usage/list#c="
+        links["devices"][mac] = devlinks
+
+    return links
+
+
+def set_meraki_dashboard_map(dbmap):
+    '''
+    Replaces the dashboard map, and rebuilds the cross-launch link table from it. Should be called whenever the map is
+    loaded or changed.
+
+    :param dbmap: Dictionary. The dashboard map, or None if dashboard cross-launching is not available
+    :return: Nothing
+    '''
+    global meraki_dashboard_map, meraki_dashboard_links
+
+    meraki_dashboard_links = build_dashboard_links(dbmap)
+    meraki_dashboard_map = dbmap
 
 
 def meraki_create_dashboard_link(linktype, linkname, displayval, urlappend, linknameid):
@@ -169,56 +880,55 @@ def meraki_create_dashboard_link(linktype, linkname, displayval, urlappend, link
     :return: String. A hyperlink (<a>) linking to the dashboard if possible
     '''
 
-    shownet = displayval
+    if not displayval:
+        displayval = linkname
 
-    # Only run if we were able to get a dashboard map using the username password of the user
-    if meraki_dashboard_map:
-        # Used to work differently... just remapping the variable now.
-        mapjson = meraki_dashboard_map          #json.loads(meraki_dashboard_map.replace("'", '"'))
-        # If 'devices' or 'networks' is present in the map (it should be)
-        if linktype in mapjson:
-            # If the given mac address or network name is present in the map (it should be)
-            if linkname in mapjson[linktype]:
-                # Create the hyperlink
-                if not displayval:
-                    displayval = linkname
-                shownet = "<a href='" + mapjson[linktype][linkname]["baseurl"] + urlappend + "'>" + displayval + "</a>"
+    # If the given mac address or network name is present in the link table, create the hyperlink
+    linkbase = meraki_dashboard_links[linktype].get(linkname)
+    if linkbase:
+        if linktype == "devices":
+            linkbase = linkbase["base"]
+        return linkbase + urlappend + "'>" + displayval + "</a>"
 
-    # If shownet is the same as displayval, it means there was a problem above. Try to add generic link... if this is
-    # a device, and doesn't include port-level detail
-    if shownet == displayval and linktype == "devices" and linknameid == 0:
-        # Create the generic hyperlink
-        shownet = "<a href='https://dashboard.meraki.com/manage/nodes/show/" + linkname + "'>" + displayval + "</a>"
+    # Not in the dashboard map. Try to add generic link... if this is a device, and doesn't include port-level detail
+    if linktype == "devices" and linknameid == 0:
+        return "<a href='https://dashboard.meraki.com/manage/nodes/show/" + linkname + "'>" + displayval + "</a>"
 
-    return shownet
+    return displayval
 
 
-def meraki_dashboard_client_mod(netlink, cliid, clidesc):
+def meraki_dashboard_device_links(devmac, devname, switchport, cliid, clidesc):
     '''
-    This function is used as an extension of the meraki_create_dashboard_link function, and used to generate the
-    client-specific cross-launch links. It can also create a generic cross-launch link if the dashboard
-    username/password were not provided, but that is not nearly as reliable.
+    Creates the device, port and client cross-launch links for one row of a client check. Falls back to generic links
+    if the device is not in the dashboard map.
 
-    :param netlink: String. The hyperlink from a 'network' call to the meraki_create_dashboard_link function.
+    :param devmac: String. Mac address of the device the client is connected to
+    :param devname: String. Name of the device. This is what gets displayed for the device hyperlink (the mac address
+                    is displayed if the device has no name).
+    :param switchport: String. Port the client is connected to
     :param cliid: String. The unique ID of the client.
-    :param clidesc: String. The name of the client. This is what gets displayed for the hyperlink.
-    :return:
+    :param clidesc: String. The name of the client. This is what gets displayed for the client hyperlink (the client
+                    ID is displayed if the client has no name).
+    :return: Tuple. (device link, port link, client link)
     '''
-
-    showcli = clidesc
-
-    # If the meraki_create_dashboard_link function generated a hyperlink, and it was passed to this function, then
-    # we will attempt to modify
-    if netlink:
-        # We are searching the string for /manage, and will strip everything after that and reconstruct
-        if netlink.find("/manage") >= 0:
-            # Create the hyperlink
-            showcli = netlink.split("/manage")[0] + "/manage/usage/list#c=" + cliid + "'>" + clidesc + "</a>"
+    if not devname:
+        devname = devmac
+    if not clidesc:
+        clidesc = cliid
+    devlinks = meraki_dashboard_links["devices"].get(devmac)
+    if not devlinks:
+        # Generic hyperlinks. There is no generic link to the port level.
+        return ("<a href='https://dashboard.meraki.com/manage/nodes/show/" + devmac + "'>" + devname + "</a>",
+                switchport,
+                "<a href='https://dashboard.meraki.com/manage/usage/list#c=" + cliid + "'>" + clidesc + "</a>")
+
+    showdev = devlinks["device"] + devname + "</a>"
+    showport = devlinks["port"] + switchport + "?timespan=" + meraki_client_to + "'>" + switchport + "</a>"
+    if devlinks["client"]:
+        showcli = devlinks["client"] + cliid + "'>" + clidesc + "</a>"
     else:
-        # Create the generic hyperlink
-        showcli = "<a href='https://dashboard.meraki.com/manage/usage/list#c=" + cliid + "'>" + clidesc + "</a>"
-
-    return showcli
+        showcli = clidesc
+    return showdev, showport, showcli
 
 
 def collect_url_list(jsondata, baseurl, attr1, attr2, battr1, battr2):
@@ -307,9 +1017,35 @@ def collect_url_list(jsondata, baseurl, attr1, attr2, battr1, battr2):
     return urllist
 
 
-def do_multi_get(url_list, comp_list, comp_id1, comp_id2, comp_url_idx, comp_key, content_key):
+def build_comp_map(comp_list, comp_id1, comp_id2):
+    '''
+    Builds a hash map from join key to record for the comparision list used by do_multi_get. If a key appears more
+    than once, the first record wins.
+
+    :param comp_list: List or Dictionary. The comparision list passed to do_multi_get
+    :param comp_id1: String. when using a list of dictionaries, this is the key to retrieve from each dict in the list
+                        when using a dictionary of lists, this is the key where all of the lists will be found
+    :param comp_id2: String. (optional) pass "" when using a list of dictionaries
+                        when using a dictionary of lists, this is key that will be retrieved from each dict in each list
+    :return: Dictionary. For a list of dictionaries, {key: record}. For a dictionary of lists, {key: (list key, record)}
+    '''
+    comp_map = {}
+    for net in comp_list:
+        if comp_id2 == "":
+            if comp_id1 in net and net[comp_id1] not in comp_map:
+                comp_map[net[comp_id1]] = net
+        elif comp_id1 in comp_list[net]:
+            for net2 in comp_list[net][comp_id1]:
+                if comp_id2 in net2 and net2[comp_id2] not in comp_map:
+                    comp_map[net2[comp_id2]] = (net, net2)
+    return comp_map
+
+
+def do_multi_get(url_list, comp_list, comp_id1, comp_id2, comp_url_idx, comp_key, content_key,
+                 priority=meraki_api_scheduler.PRIORITY_INTERACTIVE, item_filter=None, stop_when=None):
     '''
     Issues multiple GET requests to a list of URLs. Also will join dictionaries together based on returned content.
+    The requests are issued through the rate-limit-aware request scheduler.
 
     :param url_list: List. list of URLs to issue GET requests to
     :param comp_list: List. (optional) pass [] to disable
@@ -328,22 +1064,24 @@ def do_multi_get(url_list, comp_list, comp_id1, comp_id2, comp_url_idx, comp_key
                         GET requests
     :param content_key: String. (optional when not merging, required when merging) pass "" to disable
                         this is the base key added to the merged dictionary for the merged data
+    :param priority: Integer. (optional) meraki_api_scheduler.PRIORITY_INTERACTIVE (default) when a user is waiting on
+                        the result, or meraki_api_scheduler.PRIORITY_BACKGROUND for background refreshes
+    :param item_filter: Function. (optional) called with each item of each response as it arrives; only the items it
+                        returns True for are kept. Responses with no matching items are dropped entirely, so memory is
+                        bounded by the number of matches rather than the size of every response.
+    :param stop_when: Function. (optional) called with the merged results after each response; once it returns True,
+                        no further responses are processed and any requests that have not been issued are cancelled
     :return:
     '''
 
-    # Create a session that can automatically retry when an error condition is encountered.
-    s = requests.Session()
-    retries = Retry(total=5, backoff_factor=0.2, status_forcelist=[403, 500, 502, 503, 504], raise_on_redirect=True,
-                    raise_on_status=True)
-    s.mount('http://', HTTPAdapter(max_retries=retries))
-    s.mount('https://', HTTPAdapter(max_retries=retries))
-
-    # Execute all GET requests
-    rs = (grequests.get(u, headers=header, session=s) for u in url_list)
-
     content_dict = {}
-    # Parse request responses
-    for itemlist in grequests.imap(rs, stream=False):
+    # Build a hash map of the comparision list up front, so that each response is joined with a single lookup rather
+    # than a scan of every network / device
+    comp_map = build_comp_map(comp_list, comp_id1, comp_id2)
+
+    # Execute all GET requests, and parse request responses as they complete
+    responses = meraki_api_scheduler.multi_get(url_list, header, get_meraki_org(), priority)
+    for itemlist in responses:
         # Pull out the content and convert into JSON
         icontent = itemlist.content.decode("utf-8")
         inlist = json.loads(icontent)
@@ -355,42 +1093,41 @@ def do_multi_get(url_list, comp_list, comp_id1, comp_id2, comp_url_idx, comp_key
                 matchval = urllist[comp_url_idx]
             else:
                 matchval = inlist[0][comp_key]
+            # Drop anything the caller is not interested in, before it is merged in
+            if item_filter:
+                inlist = [item for item in inlist if item_filter(item)]
+                if not inlist:
+                    continue
 
             # Check to see if a comparision list was provided
             if len(comp_list) > 0:
-                # comp_list was passed, iterate and merge dictionaries
-                for net in comp_list:
+                # comp_list was passed, look up the match and merge dictionaries
+                if matchval in comp_map:
                     if comp_id2 == "":
-                        # This is a list of dictionaries. if this matches the search, add it to the content dict
-                        if matchval == net[comp_id1]:
-                            kid1 = net["id"]
-
-                            if kid1 not in content_dict:
-                                content_dict[kid1] = {}
-                            content_dict[kid1]["info"] = net
-                            content_dict[kid1][content_key] = inlist
-                            break
+                        # This is a list of dictionaries. add the matching entry to the content dict
+                        net = comp_map[matchval]
+                        kid1 = net["id"]
+
+                        if kid1 not in content_dict:
+                            content_dict[kid1] = {}
+                        content_dict[kid1]["info"] = net
+                        content_dict[kid1][content_key] = inlist
                     else:
-                        # This is a dictionary of lists. if the match is present in this dictionary, continue parsing
-                        if matchval in json.dumps(comp_list[net][comp_id1]):
-                            kid1 = comp_list[net]["info"]["id"]
-
-                            for net2 in comp_list[net][comp_id1]:
-                                kid2 = net2["serial"]
-
-                                if comp_id2 in net2:
-                                    if matchval == net2[comp_id2]:
-                                        if kid1 not in content_dict:
-                                            content_dict[kid1] = {}
-                                        if comp_id1 not in content_dict[kid1]:
-                                            content_dict[kid1][comp_id1] = {}
-                                        if kid2 not in content_dict[kid1][comp_id1]:
-                                            content_dict[kid1][comp_id1][kid2] = {}
-
-                                        content_dict[kid1]["info"] = comp_list[net]
-                                        content_dict[kid1][comp_id1][kid2]["info"] = net2
-                                        content_dict[kid1][comp_id1][kid2][content_key] = inlist
-                                        break
+                        # This is a dictionary of lists. add the matching entry under its network
+                        net, net2 = comp_map[matchval]
+                        kid1 = comp_list[net]["info"]["id"]
+                        kid2 = net2["serial"]
+
+                        if kid1 not in content_dict:
+                            content_dict[kid1] = {}
+                        if comp_id1 not in content_dict[kid1]:
+                            content_dict[kid1][comp_id1] = {}
+                        if kid2 not in content_dict[kid1][comp_id1]:
+                            content_dict[kid1][comp_id1][kid2] = {}
+
+                        content_dict[kid1]["info"] = comp_list[net]
+                        content_dict[kid1][comp_id1][kid2]["info"] = net2
+                        content_dict[kid1][comp_id1][kid2][content_key] = inlist
             else:
                 # No comp_list was passed.
                 if matchval not in content_dict:
@@ -402,6 +1139,12 @@ def do_multi_get(url_list, comp_list, comp_id1, comp_id2, comp_url_idx, comp_key
                 else:
                     content_dict[matchval] = inlist
 
+            # Stop early if the caller already has what it needs
+            if stop_when and stop_when(content_dict):
+                break
+
+    # Cancel any requests that are still waiting to be issued
+    responses.close()
     return content_dict
 
 
@@ -430,58 +1173,44 @@ def decode_model(strmodel):
     return outmodel
 
 
-def do_sort_smclients(in_smlist):
+def split_network_name(netinfo, devinfo):
     '''
-    Rearranges the SM Dictionary to group clients by MAC address rather than a single list
+    Works out the name of the dashboard network a device is shown in. The API will only provide combined networks, but
+    the dashboard shows them as 'Network Name - device type'.
 
-    :param in_smlist: List. List of non-organized SM clients
-    :return: Dictionary. Dictionary of SM clients organized by MAC address
+    :param netinfo: Dictionary. The network the device belongs to
+    :param devinfo: Dictionary. The device
+    :return: String. The dashboard network name
     '''
-    out_smlist = {}
-
-    # Iterate list of networks
-    for net in in_smlist:
-        # If there are devices in the network, iterate the list of networks
-        if "devices" in in_smlist[net]:
-            for cli in in_smlist[net]["devices"]:
-                # If the network is not already in the return dictionary, add it now
-                if net not in out_smlist:
-                    out_smlist[net] = {"devices": {}}
-                # Add this client to a dictionary key cooresponding to the mac address of the client
-                out_smlist[net]["devices"][cli["wifiMac"]] = cli
+    # Don't try to un-combine already non-combined networks...
+    if netinfo["type"] != "combined" or not devinfo.get("model"):
+        return netinfo["name"]
+    # Look up the Model number to determine what the dashboard name will be
+    return netinfo["name"] + " - " + decode_model(devinfo["model"])
 
-    return out_smlist
 
-
-def do_split_networks(in_netlist):
+def do_split_networks(in_netlist, inventory=None):
     '''
     Splits out combined Meraki networks into individual device networks. The API will only provide combined networks.
     In order to build Dashboard cross-launch links, we will need to carve these combined networks up into the
     cooresponding individual networks.
 
     :param in_netlist: Dictionary. Dict of all networks for the provided/derived organization.
-    :return: Dictionary. Updated to break out devices into their individual networks.
+    :param inventory: Dictionary. (optional) Organization inventory; the split network names are taken from here.
+    :return: Dictionary. Updated to break out devices into their individual networks. The device entries are the same
+             objects as in in_netlist.
     '''
     devdict = {}
 
     # Iterate dictionary of networks
     for net in in_netlist:
-        base_name = in_netlist[net]["info"]["name"]
         # Iterate dictionary of devices in the currently iterated network
         for devsn in in_netlist[net]["devices"]:
-            dev = in_netlist[net]["devices"][devsn]
-            thisstat = {"status": in_netlist[net]["devices"][dev["serial"]]["status"]}
-            # Don't try to un-combine already non-combined networks...
-            if in_netlist[net]["info"]["type"] != "combined":
-                newname = base_name
-                newdev = {**dev, **thisstat}
+            newdev = in_netlist[net]["devices"][devsn]
+            if inventory and devsn in inventory["split_names"]:
+                newname = inventory["split_names"][devsn]
             else:
-                # Look up the Model number to determine what the dashboard name will be
-                thisdevtype = decode_model(dev["info"]["model"])
-                # Also, retain uplink data for output dict
-                # This is the format of the output network. 'Network Name - device type"
-                newname = base_name + " - " + thisdevtype
-                newdev = {**dev, **thisstat}
+                newname = split_network_name(in_netlist[net]["info"], newdev)
 
             # Append or create this entry in the output dict
             if newname in devdict:
@@ -492,88 +1221,437 @@ def do_split_networks(in_netlist):
     return devdict
 
 
+def get_client_timespans():
+    '''
+    Works out the timespans to use for a progressive client search. If MERAKI_CLIENT_MIN_TIMESPAN is set, the search
+    starts there and widens by a factor of 4 each time, up to MERAKI_CLIENT_TIMESPAN. Otherwise, only
+    MERAKI_CLIENT_TIMESPAN is used.
+
+    :return: List. Timespans to search, in seconds, shortest first
+    '''
+    maxspan = int(meraki_client_to)
+    if not meraki_client_min_to or int(meraki_client_min_to) <= 0:
+        return [maxspan]
+
+    spanlist = []
+    span = int(meraki_client_min_to)
+    while span < maxspan:
+        spanlist.append(span)
+        span *= 4
+    spanlist.append(maxspan)
+    return spanlist
+
+
+def find_client_locations(netlist, client_id):
+    '''
+    Finds where the user was seen in a client fan-out, on a switchport (duplicate clients from MX security appliances
+    do not have a switchport, and are not shown in the client check)
+
+    :param netlist: Dictionary. Result of do_multi_get for /devices/{serial}/clients
+    :param client_id: String. Client username
+    :return: List. Unique (networkId, serial) tuples where the user was seen
+    '''
+    locations = []
+    for net in netlist:
+        for dev in netlist[net]["devices"]:
+            for cli in netlist[net]["devices"][dev]["clients"]:
+                if meraki_client_index.client_matches(cli, client_id, []) and cli.get("switchport") is not None:
+                    if (net, dev) not in locations:
+                        locations.append((net, dev))
+    return locations
+
+
+def is_client_found(netlist, client_id):
+    '''
+    Checks whether a client fan-out found the user on any device (wired or wireless)
+
+    :param netlist: Dictionary. Result of do_multi_get for /devices/{serial}/clients
+    :param client_id: String. Client username
+    :return: true/false based on whether the user was found
+    '''
+    for net in netlist:
+        for dev in netlist[net]["devices"]:
+            for cli in netlist[net]["devices"][dev]["clients"]:
+                if meraki_client_index.client_matches(cli, client_id, []):
+                    return True
+    return False
+
+
+def is_search_complete(netlist, client_id, macs):
+    '''
+    Checks whether a client fan-out has found everything a check shows: the user on a switchport, and all of the
+    user's phones. Used to cancel the rest of a fan-out early.
+
+    :param netlist: Dictionary. Result of do_multi_get for /devices/{serial}/clients
+    :param client_id: String. Client username
+    :param macs: List. MAC addresses of the user's phones
+    :return: true/false based on whether everything being searched for was found
+    '''
+    if not find_client_locations(netlist, client_id):
+        return False
+    foundmacs = set()
+    for net in netlist:
+        for dev in netlist[net]["devices"]:
+            for cli in netlist[net]["devices"][dev]["clients"]:
+                if not isinstance(cli, str) and cli.get("mac") in macs:
+                    foundmacs.add(cli["mac"])
+    return len(foundmacs) == len(set(macs))
+
+
+def build_network_health(inventory):
+    '''
+    Builds the per-network health summary used by meraki-health. This is rebuilt each time the device statuses (or the
+    inventory) change, so a health check only has to look at the networks it is going to show.
+
+    :param inventory: Dictionary. Organization inventory from build_org_inventory
+    :return: Dictionary. networks ({dashboard network name: {"devices": count, "offline": count}}), names (sorted),
+             lnames (the same names in lowercase, for pattern searches), offline (set of names with a device offline),
+             and the devices / offline totals for the organization
+    '''
+    # Get the status of all devices in the organization
+    statlist = get_org_device_statuses(inventory)
+    # Split network lists up by device type
+    newnetlist = do_split_networks(statlist, inventory)
+
+    health = {"networks": {}, "names": sorted(newnetlist), "lnames": [], "offline": set(), "devices": 0,
+              "offline_devices": 0}
+    for net in health["names"]:
+        offdev = len([dev for dev in newnetlist[net] if dev["status"] != "online"])
+        health["networks"][net] = {"devices": len(newnetlist[net]), "offline": offdev}
+        health["lnames"].append(net.lower())
+        health["devices"] += len(newnetlist[net])
+        health["offline_devices"] += offdev
+        if offdev > 0:
+            health["offline"].add(net)
+
+    return health
+
+
+def get_command_args(incoming_msg, command):
+    '''
+    Returns the words following a command, leaving out any 'org:' option (see get_target_orgs)
+
+    :param incoming_msg: String. this is the message that is posted in Spark
+    :param command: String. The end of the command name, eg 'health' (matches both 'health' and 'meraki-health')
+    :return: List. The words after the command
+    '''
+    cmdlist = [cmd for cmd in incoming_msg.text.split() if not cmd.lower().startswith("org:")]
+    # Skip the bot mention (if any) and the command itself
+    for x in range(0, len(cmdlist)):
+        if cmdlist[x].lower().endswith(command):
+            return cmdlist[x + 1:]
+    return []
+
+
+def get_health_args(incoming_msg):
+    '''
+    Parses the options of a health check: 'meraki-health [org:<organization>] [offline | <network name search>]
+    [page <n>]'
+
+    :param incoming_msg: String. this is the message that is posted in Spark
+    :return: Tuple. (search string or "", offline only true/false, page number)
+    '''
+    cmdlist = get_command_args(incoming_msg, "health")
+
+    page = 1
+    if len(cmdlist) >= 2 and cmdlist[-2].lower() == "page" and cmdlist[-1].isdigit():
+        page = max(1, int(cmdlist[-1]))
+        cmdlist = cmdlist[:-2]
+    if len(cmdlist) == 1 and cmdlist[0].lower() == "offline":
+        return "", True, page
+    return " ".join(cmdlist), False, page
+
+
 def get_meraki_health(incoming_msg, rettype):
     '''
-    This function will return health data for the Meraki networks that are part of the provided/derived organization
+    This function will return health data for the Meraki networks that are part of the provided/derived organization.
+    In multi-organization mode, the health of each organization (or the one given with 'org:') is collected in
+    parallel.
 
     :param incoming_msg: String. this is the message that is posted in Spark
     :param rettype: String. this is a fully formatted string that will be sent back to Spark
     :return:
     '''
+    orgs = get_target_orgs(incoming_msg)
+    if not orgs:
+        return "<h3>Meraki Details:</h3>Unknown Meraki organization."
+    orghealth = run_across_orgs(orgs, get_org_health, incoming_msg)
+    if orgs == [None]:
+        return orghealth[0]
+
+    retmsg = ""
+    orgnames = get_meraki_org_names()
+    for x in range(0, len(orgs)):
+        retmsg += "<h2>Organization: " + orgnames.get(orgs[x], orgs[x]) + "</h2>" + orghealth[x]
+    return retmsg
 
-    # Get a list of all networks associated with the specified organization
-    netjson = get_meraki_networks()
 
-    # Get a list of all devices in the organization
-    statlist = get_org_device_statuses(netjson)
-    # Split network lists up by device type
-    newnetlist = do_split_networks(statlist)
+def get_org_health(incoming_msg):
+    '''
+    Builds the health check for a single organization. The networks can be filtered by name or to those with devices
+    offline, and are shown MERAKI_HEALTH_PAGE_SIZE at a time.
+
+    :param incoming_msg: String. this is the message that is posted in Spark
+    :return: String. A fully formatted string that will be sent back to Spark
+    '''
+
+    search, offline, page = get_health_args(incoming_msg)
+    # Get the inventory (networks and devices) of the organization, and the health summary of each network
+    inventory = meraki_cache.get_tier(org_tier("inventory"))
+    health = meraki_cache.get_tier(org_tier("network_health"))
+    if inventory is None or health is None:
+        return "<h3>Meraki Details:</h3>Unable to retrieve the organization from the Meraki Dashboard API."
+
+    # Pick out the networks to show. Only the names are searched; the device counts are already summarised.
+    if offline:
+        netnames = sorted(health["offline"])
+    elif search:
+        lsearch = search.lower()
+        netnames = [health["names"][x] for x in range(0, len(health["names"])) if lsearch in health["lnames"][x]]
+    else:
+        netnames = health["names"]
+    pagesize = int(meraki_health_page_size)
+    if pagesize <= 0:
+        pagesize = max(1, len(netnames))
+    pagecount = max(1, (len(netnames) + pagesize - 1) // pagesize)
+    page = min(page, pagecount)
 
-    totaldev = 0
-    offdev = 0
-    totaloffdev = 0
-    devicon = ""
     retmsg = "<h3>Meraki Details:</h3>"
     if meraki_over_dash:
         retmsg += "<a href='" + meraki_over_dash + "'>Meraki Dashboard</a><br><ul>"
     else:
         retmsg += "<a href='https://dashboard.meraki.com/'>Meraki Dashboard</a><br><ul>"
-    # Iterate through all of the networks, sorted by name
-    for net in sorted(newnetlist):
-        # Iterate through all devices in the currently iterated network
-        for dev in newnetlist[net]:
-            # Check status of the device
-            if dev["status"] != "online":
-                offdev += 1
-                totaloffdev += 1
-                devicon = chr(0x2757) + chr(0xFE0F)
-
-        # Increment the total number of devices
-        totaldev += len(newnetlist[net])
+    # Iterate through the networks on this page, sorted by name
+    pagenets = netnames[(page - 1) * pagesize:page * pagesize]
+    for net in pagenets:
+        nethealth = health["networks"][net]
+        devicon = ""
+        if nethealth["offline"] > 0:
+            devicon = chr(0x2757) + chr(0xFE0F)
         # Attempt to create a dashboard cross-launch link (no generic link available), then append data for this network
         shownet = meraki_create_dashboard_link("networks", net, net, "", 0)
-        retmsg += "<li>Network '" + shownet + "' has " + str(offdev) + " device(s) offline out of " + str(len(newnetlist[net])) + " device(s)." + devicon + "</li>"
-        offdev = 0
-        devicon = ""
+        retmsg += "<li>Network '" + shownet + "' has " + str(nethealth["offline"]) + " device(s) offline out of " + str(nethealth["devices"]) + " device(s)." + devicon + "</li>"
+    retmsg += "</ul>"
+    if pagecount > 1:
+        retmsg += "<i>Page " + str(page) + " of " + str(pagecount) + " (" + str(len(netnames)) + " networks). Add 'page &lt;n&gt;' to see more.</i><br>"
     # Append summary data
-    retmsg += "</ul><b>" + str(totaloffdev) + " device(s) offline out of a total of " + str(totaldev) + " device(s).</b>"
+    if offline or search:
+        retmsg += "<b>" + str(sum(health["networks"][net]["offline"] for net in netnames)) + " device(s) offline out of " + str(sum(health["networks"][net]["devices"] for net in netnames)) + " device(s) in " + str(len(netnames)) + " matching network(s).</b><br>"
+    retmsg += "<b>" + str(health["offline_devices"]) + " device(s) offline out of a total of " + str(health["devices"]) + " device(s).</b>"
+    # Append the WAN uplink summary. Uplinks are only read from the cache (the background refresher fetches them), so
+    # there is nothing to show until the first refresh has completed.
+    # When the networks are filtered or paged, only the appliances in the networks shown are included.
+    uplinks = meraki_cache.peek_tier(org_tier("uplinks"))
+    if uplinks:
+        if offline or search or pagecount > 1:
+            retmsg += get_uplink_summary(inventory, uplinks, pagenets)
+        else:
+            retmsg += get_uplink_summary(inventory, uplinks)
+    # Let the user know how old the cached statuses are. The network and device lists are kept much longer, but only
+    # change when the organization does, so their age is not shown.
+    retmsg += "<br><i>" + meraki_cache.format_age([org_tier("statuses")], "Device status")
+    if uplinks:
+        retmsg += " " + meraki_cache.format_age([org_tier("uplinks")], "Uplink status")
+    retmsg += "</i>"
+
+    return retmsg
+
+
+def format_minutes(secs):
+    '''
+    Formats a number of seconds as whole minutes
 
+    :param secs: Integer. Number of seconds
+    :return: String. eg '5 minute(s)'
+    '''
+    return str(int(secs) // 60) + " minute(s)"
+
+
+def get_meraki_trend(incoming_msg, rettype):
+    '''
+    This function will return the offline time and flaps of the Meraki networks (or, for a network name search, the
+    devices in the matching networks), from the health trend store. In multi-organization mode, each organization (or
+    the one given with 'org:') is included.
+
+    :param incoming_msg: String. this is the message that is posted in Spark
+    :param rettype: String. this is a fully formatted string that will be sent back to Spark
+    :return:
+    '''
+    orgs = get_target_orgs(incoming_msg)
+    if not orgs:
+        return "<h3>Meraki Trends:</h3>Unknown Meraki organization."
+    orgtrend = run_across_orgs(orgs, get_org_trend, incoming_msg)
+    if orgs == [None]:
+        return orgtrend[0]
+
+    retmsg = ""
+    orgnames = get_meraki_org_names()
+    for x in range(0, len(orgs)):
+        retmsg += "<h2>Organization: " + orgnames.get(orgs[x], orgs[x]) + "</h2>" + orgtrend[x]
     return retmsg
 
 
-def get_meraki_clients(incoming_msg, rettype):
+def get_org_trend(incoming_msg):
+    '''
+    Builds the trend summary for a single organization: 'meraki-trend [network name search]'
+
+    :param incoming_msg: String. this is the message that is posted in Spark
+    :return: String. A fully formatted string that will be sent back to Spark
+    '''
+    search = " ".join(get_command_args(incoming_msg, "trend")).lower()
+    org = get_meraki_org()
+    samples, window = meraki_trend_store.get_trend_window(org)
+
+    retmsg = "<h3>Meraki Trends:</h3>"
+    if samples == 0:
+        return retmsg + "No trend data has been recorded yet."
+    retmsg += "Over the last " + format_minutes(window) + " (" + str(samples) + " samples):<ul>"
+
+    inventory = meraki_cache.peek_tier(org_tier("inventory"))
+    netnames = meraki_trend_store.get_trend_names(org)
+    quiet = 0
+    if search:
+        # Show every matching network, along with any of its devices that were offline or flapped
+        for net in [n for n in netnames if search in n.lower()]:
+            trend = meraki_trend_store.get_trend(org, "networks", net)
+            shownet = meraki_create_dashboard_link("networks", net, net, "", 0)
+            retmsg += "<li>Network '" + shownet + "' had a device offline for " + format_minutes(trend["offline_secs"]) + ", " + str(trend["flaps"]) + " flap(s).</li>"
+            for serial in meraki_trend_store.get_trend_devices(org, net):
+                devtrend = meraki_trend_store.get_trend(org, "devices", serial)
+                if devtrend and (devtrend["offline_secs"] > 0 or devtrend["flaps"] > 0):
+                    devinfo = (inventory or {}).get("devices", {}).get(serial, {})
+                    showdev = meraki_create_dashboard_link("devices", devinfo.get("mac", ""), devinfo.get("name") or serial, "", 0)
+                    retmsg += "<li>&nbsp;&nbsp;Device '" + showdev + "' offline for " + format_minutes(devtrend["offline_secs"]) + ", " + str(devtrend["flaps"]) + " flap(s).</li>"
+    else:
+        # Show the networks that had a device offline, the ones that flapped the most first
+        trends = []
+        for net in netnames:
+            trend = meraki_trend_store.get_trend(org, "networks", net)
+            if trend["offline_secs"] > 0 or trend["flaps"] > 0:
+                trends.append((net, trend))
+            else:
+                quiet += 1
+        for net, trend in sorted(trends, key=lambda t: (-t[1]["flaps"], -t[1]["offline_secs"], t[0])):
+            shownet = meraki_create_dashboard_link("networks", net, net, "", 0)
+            retmsg += "<li>Network '" + shownet + "' had a device offline for " + format_minutes(trend["offline_secs"]) + ", " + str(trend["flaps"]) + " flap(s)." + chr(0x2757) + chr(0xFE0F) + "</li>"
+    retmsg += "</ul>"
+    if quiet > 0:
+        retmsg += "<b>" + str(quiet) + " other network(s) had no devices offline.</b>"
+
+    return retmsg
+
+
+def get_org_clients(client_id, phone_macs):
+    '''
+    Finds a client in a single organization. If the client location index has been built, the client (and phones) are
+    looked up there, and only the devices they were seen on are asked for their clients. Otherwise, every device in the
+    organization inventory is asked.
+
+    :param client_id: String. Client username, IP address, CIDR range or MAC address prefix
+    :param phone_macs: List. MAC addresses of the user's phones, or None
+    :return: Tuple. (clients of the devices the client was found on, in the form
+             {networkId: {"info": ..., "devices": {serial: {"info": device, "clients": [...]}}}},
+             Systems Manager device catalog,
+             port statuses of the switches the client and phones were found on, from get_switch_port_statuses)
+    '''
+    # Get the Systems Manager device catalog. Until it has been retrieved, nothing is cross-referenced with SM.
+    newsmlist = meraki_cache.get_tier(org_tier("sm"))
+    if newsmlist is None:
+        newsmlist = meraki_sm_catalog.empty_catalog
+    # Nothing can be searched until the organization's devices have been retrieved
+    if meraki_cache.get_tier(org_tier("inventory")) is None:
+        return {}, newsmlist, {}
+
+    # Look up the client in the location index, if the background job has built it
+    locations = []
+    client_index = meraki_cache.peek_tier(org_tier("client_index"))
+    if client_index is not None:
+        locations = meraki_client_index.lookup_client_index(client_index, client_id, phone_macs or [])
+
+    if locations:
+        # Only poll the devices the client was seen on, to pick up anything since the last poll, then answer from the
+        # client store
+        netlist = poll_org_clients([loc[1] for loc in locations])
+    elif meraki_client_fetch_mode == "network":
+        # Polling every network costs one request per network, so poll the whole organization through the client store
+        netlist = poll_org_clients(None)
+    else:
+        # Get a list of all devices associated with the networks associated to the organization, from the cached
+        # organization inventory (the same one used by the health check and uplink status)
+        devlist = get_inventory_netlist(meraki_cache.get_tier(org_tier("inventory")), None)
+        macs = phone_macs or []
+        # Devices the user was last found on are asked first
+        hints = [loc[1] for loc in meraki_client_index.get_client_hints(client_id)]
+        # A CIDR range or MAC prefix can match any number of clients, so only stop early when looking for one client
+        querytype, queryval = meraki_client_index.parse_client_query(client_id)
+        stop_when = None
+        if querytype == "name" or (querytype == "ip" and queryval[1] == queryval[2]) or (querytype == "mac" and len(queryval) == 12):
+            stop_when = lambda cd: is_search_complete(cd, client_id, macs)
+        # Search the most recent clients first, and only look further back if the user was not found at all (a
+        # phone that is offline, or a user that is only on wireless, does not widen the search)
+        for span in get_client_timespans():
+            # Parse list of devices to extract/create URLs needed to get list of clients
+            urldev = collect_url_list(devlist, "https://dashboard.meraki.com/api/v0/devices/$1/clients?timespan=" + str(span), "devices", "serial", "", "")
+            urldev.sort(key=lambda u: u.split("/")[6].split("?")[0] not in hints)
+            # Get the clients associated with the devices associated to the networks associated to the organization.
+            # Only the clients that match the user (or their phones) are kept as each response arrives, and the
+            # remaining requests are cancelled once everything has been found.
+            netlist = do_multi_get(urldev, devlist, "devices", "serial", 6, "", "clients",
+                                   item_filter=lambda cli: meraki_client_index.client_matches(cli, client_id, macs),
+                                   stop_when=stop_when)
+            if is_client_found(netlist, client_id):
+                break
+
+    # Remember where the user was found, for the next check
+    meraki_client_index.remember_client_locations(client_id, find_client_locations(netlist, client_id))
+
+    # Get the port statuses of every switch the user or their phones are connected to, once per switch
+    switches = set()
+    for net in netlist:
+        for dev in netlist[net]["devices"]:
+            for cli in netlist[net]["devices"][dev]["clients"]:
+                if meraki_client_index.client_matches(cli, client_id, phone_macs or []) and cli.get("switchport") is not None:
+                    switches.add(dev)
+    ports = get_switch_port_statuses(list(switches))
+
+    return netlist, newsmlist, ports
+
+
+def get_meraki_clients(incoming_msg, rettype, phone_macs=None):
     '''
     This function will return client data for the Meraki networks that are part of the provided/derived organization
+    (see get_org_clients). In multi-organization mode, every organization (or the one given with 'org:') is searched in
+    parallel.
 
     :param incoming_msg: String. this is the message that is posted in Spark. The client's username will be parsed
                         out from this.
     :param rettype: String. html or json
+    :param phone_macs: List. (optional) MAC addresses of the user's phones, so their locations are included as well
     :return: String (if rettype = html). This is a fully formatted string that will be sent back to Spark
-             Dictionary (if rettype = json). Raw data that is expected to be consumed in cico_combined
+             Dictionary (if rettype = json). Raw data that is expected to be consumed in cico_combined: client, sm and
+             ports (switch port statuses, see format_port_status)
     '''
 
     devcount = 0
     # Get client username
-    cmdlist = incoming_msg.text.split(" ")
-    client_id = cmdlist[len(cmdlist)-1]
-    # Get a list of all networks associated with the specified organization
-    netjson = get_meraki_networks()
-    # Parse list of networks to extract/create URLs needed to get list of devices
-    urlnet = collect_url_list(netjson, "https://dashboard.meraki.com/api/v0/networks/$1/devices", "id", "", "", "")
-    smnet = collect_url_list(netjson, "https://dashboard.meraki.com/api/v0/networks/$1/sm/devices/", "id", "", "", "")
-    # Get a list of all devices associated with the networks associated to the organization
-    netlist = do_multi_get(urlnet, netjson, "id", "", -1, "networkId", "devices")
-    smlist = do_multi_get(smnet, [], "id", "", 6, "", "")
-    newsmlist = do_sort_smclients(smlist)
-    smnetid = smnet[0].split("/")[6]
-    # Parse list of devices to extract/create URLs needed to get list of clients
-    urldev = collect_url_list(netlist, "https://dashboard.meraki.com/api/v0/devices/$1/clients?timespan=" + meraki_client_to, "devices", "serial", "", "")
-    # Get a list of all clients associated with the devices associated to the networks associated to the organization
-    netlist = do_multi_get(urldev, netlist, "devices", "serial", 6, "", "clients")
+    client_id = cico_common.get_client_id(incoming_msg)
+
+    # Look for the client in each organization (in parallel, in multi-organization mode)
+    netlist = {}
+    smcatalogs = []
+    ports = {}
+    for orgnetlist, orgsmlist, orgports in run_across_orgs(get_target_orgs(incoming_msg), get_org_clients, client_id, phone_macs):
+        netlist.update(orgnetlist)
+        smcatalogs.append(orgsmlist)
+        ports.update(orgports)
+    if len(smcatalogs) == 1:
+        newsmlist = smcatalogs[0]
+    else:
+        newsmlist = meraki_sm_catalog.merge_sm_catalogs(smcatalogs)
 
     # If returning json, don't do any processing, just return raw data
     if rettype == "json":
-        return {"client": netlist, "sm": newsmlist, "smnetid": smnetid}
+        return {"client": netlist, "sm": newsmlist, "ports": ports}
     else:
         retmsg = "<h3>Associated Clients:</h3>"
         if netlist:
@@ -589,30 +1667,25 @@ def get_meraki_clients(incoming_msg, rettype):
                             # If the description of the client matches the username specified in Spark, and if this specific
                             # client has a switchport mapping, then continue (duplicate clients from MX security appliances
                             # will also be in this list, the switchport check is used to exclude those)
-                            if cli["description"] == client_id and "switchport" in cli:
+                            if meraki_client_index.client_query_matches(cli, client_id) and cli.get("switchport") is not None:
                                 devbase = netlist[net]["devices"][dev]["info"]
                                 # These functions generate the cross-launch links (if available) for the given
                                 # client/device/port
-                                showdev = meraki_create_dashboard_link("devices", devbase["mac"], devbase["name"], "?timespan=" + meraki_client_to, 0)
-                                showport = meraki_create_dashboard_link("devices", devbase["mac"], str(cli["switchport"]), "/ports/" + str(cli["switchport"]) + "?timespan=" + meraki_client_to, 1)
-                                showcli = meraki_dashboard_client_mod(showdev, cli["id"], cli["dhcpHostname"])
+                                showdev, showport, showcli = meraki_dashboard_device_links(devbase["mac"], devbase["name"], str(cli["switchport"]), cli["id"], cli["dhcpHostname"])
                                 if devcount > 0:
                                     retmsg += "<br>"
                                 devcount += 1
                                 retmsg += "<i>Computer Name:</i> " + showcli + "<br>"
 
-                                # Iterate the Systems Manager list to see if the client exists there. Iterate through networks.
-                                if net in newsmlist:
-                                    # If this network has any devices, then we will attempt to cross reference the client data
-                                    if "devices" in newsmlist[net]:
-                                        # Our cross-reference point is mac address, as it will exist in both the dashboard
-                                        # clients list as well as the systems manager clients list.
-                                        if cli["mac"] in newsmlist[net]["devices"]:
-                                            # If we are able to cross-reference, we will add some system-specific and
-                                            # OS-specific details from SM
-                                            smbase = newsmlist[net]["devices"][cli["mac"]]
-                                            retmsg += "<i>Model:</i> " + smbase["systemModel"] + "<br>"
-                                            retmsg += "<i>OS:</i> " + smbase["osName"] + "<br>"
+                                # Look the client up in the Systems Manager catalog. Our cross-reference point is mac
+                                # address, as it will exist in both the dashboard clients list as well as the systems
+                                # manager clients list.
+                                smbase = meraki_sm_catalog.lookup_sm_mac(newsmlist, cli["mac"])
+                                if smbase:
+                                    # If we are able to cross-reference, we will add some system-specific and
+                                    # OS-specific details from SM
+                                    retmsg += "<i>Model:</i> " + smbase["systemModel"] + "<br>"
+                                    retmsg += "<i>OS:</i> " + smbase["osName"] + "<br>"
 
                                 # Once we've checked for Systems Manager cross references, we will display the rest of the
                                 # client details
@@ -621,25 +1694,57 @@ def get_meraki_clients(incoming_msg, rettype):
                                 retmsg += "<i>VLAN:</i> " + str(cli["vlan"]) + "<br>"
                                 # This creates the description of the switch / port the client is connected to
                                 retmsg += "<i>Connected To:</i> " + showdev + " (" + devbase["model"] + "), Port " + showport + "<br>"
-        elif newsmlist:
-            for cli in newsmlist[smnetid]["devices"]:
-                smbase = newsmlist[smnetid]["devices"][cli]
-                if client_id.lower() in smbase["name"].lower() or client_id.lower() in [x.lower() for x in smbase["tags"]]:
-                    if devcount > 0:
-                        retmsg += "<br>"
-                    devcount += 1
-                    retmsg += "<i>Client Name:</i> " + smbase["name"] + "<br>"
-                    retmsg += "<i>Model:</i> " + smbase["systemModel"] + "<br>"
-                    retmsg += "<i>OS:</i> " + smbase["osName"] + "<br>"
-                    retmsg += "<i>MAC:</i> " + smbase["wifiMac"] + "<br>"
-                    smssid = smbase["ssid"]
-                    if smssid is None:
-                        smssid = "N/A"
-                    retmsg += "<i>Wireless SSID:</i> " + smssid + "<br>"
+                                retmsg += format_port_status(ports, dev, cli["switchport"])
+        elif newsmlist["entries"]:
+            # Search the Systems Manager catalog by name and tag
+            for smbase in meraki_sm_catalog.search_sm_catalog(newsmlist, client_id):
+                if devcount > 0:
+                    retmsg += "<br>"
+                devcount += 1
+                retmsg += "<i>Client Name:</i> " + smbase["name"] + "<br>"
+                retmsg += "<i>Model:</i> " + smbase["systemModel"] + "<br>"
+                retmsg += "<i>OS:</i> " + smbase["osName"] + "<br>"
+                retmsg += "<i>MAC:</i> " + smbase["wifiMac"] + "<br>"
+                smssid = smbase["ssid"]
+                if smssid is None:
+                    smssid = "N/A"
+                retmsg += "<i>Wireless SSID:</i> " + smssid + "<br>"
 
         return retmsg
 
 
+def get_meraki_api_stats(incoming_msg, rettype):
+    '''
+    This function will return the state of the Meraki Dashboard API request scheduler
+
+    :param incoming_msg: String. this is the message that is posted in Spark
+    :param rettype: String. html or json
+    :return: String (if rettype = html). This is a fully formatted string that will be sent back to Spark
+             Dictionary (if rettype = json). Raw scheduler statistics
+    '''
+    stats = meraki_api_scheduler.get_scheduler_stats()
+
+    # If returning json, don't do any processing, just return raw data
+    if rettype == "json":
+        return stats
+
+    retmsg = "<h3>Meraki API Scheduler:</h3><ul>"
+    retmsg += "<li>" + str(stats["queue_depth"]) + " request(s) queued, " + str(stats["in_flight"]) + " in flight.</li>"
+    retmsg += "<li>" + str(stats["completed"]) + " request(s) completed, " + str(stats["failed"]) + " failed.</li>"
+    retmsg += "<li>" + str(stats["throttled"]) + " request(s) throttled (429), " + str(stats["retried"]) + " retried.</li>"
+    for org in sorted(stats["orgs"]):
+        if org == meraki_api_scheduler.key_bucket:
+            retmsg += "<li>API key (all organizations): throttled " + str(stats["orgs"][org]["throttled"]) + " time(s)"
+        else:
+            retmsg += "<li>Organization " + org + ": throttled " + str(stats["orgs"][org]["throttled"]) + " time(s)"
+        if stats["orgs"][org]["paused"] > 0:
+            retmsg += ", paused for " + str(stats["orgs"][org]["paused"]) + " second(s)"
+        retmsg += ".</li>"
+    retmsg += "</ul>"
+
+    return retmsg
+
+
 def get_meraki_health_html(incoming_msg):
     '''
     Shortcut for bot health command, for html
@@ -650,6 +1755,16 @@ def get_meraki_health_html(incoming_msg):
     return get_meraki_health(incoming_msg, "html")
 
 
+def get_meraki_trend_html(incoming_msg):
+    '''
+    Shortcut for bot trend command, for html
+
+    :param incoming_msg: this is the message that is posted in Spark
+    :return: this is a fully formatted string that will be sent back to Spark
+    '''
+    return get_meraki_trend(incoming_msg, "html")
+
+
 def get_meraki_clients_html(incoming_msg):
     '''
     Shortcut for bot check command, for html
@@ -658,3 +1773,13 @@ def get_meraki_clients_html(incoming_msg):
     :return: this is a fully formatted string that will be sent back to Spark
     '''
     return get_meraki_clients(incoming_msg, "html")
+
+
+def get_meraki_api_stats_html(incoming_msg):
+    '''
+    Shortcut for bot api stats command, for html
+
+    :param incoming_msg: this is the message that is posted in Spark
+    :return: this is a fully formatted string that will be sent back to Spark
+    '''
+    return get_meraki_api_stats(incoming_msg, "html")
@@ -6,6 +6,7 @@ import base64
 import requests
 import json
 import os
+import cico_common
 
 # ========================================================
 # Load required parameters from environment variables
@@ -299,8 +300,7 @@ def get_spark_call_clients(incoming_msg, rettype):
     '''
 
     # Get client username
-    cmdlist = incoming_msg.text.split(" ")
-    client_id = cmdlist[len(cmdlist)-1]
+    client_id = cico_common.get_client_id(incoming_msg)
 
     # Search for user in Spark Call
     userdata = {"html": "", "json": {}}
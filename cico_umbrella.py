@@ -6,6 +6,7 @@ import os
 import gzip
 import io
 from stat import S_ISREG, S_ISDIR, ST_CTIME, ST_MODE
+import cico_common
 
 # ========================================================
 # Load required parameters from environment variables
@@ -149,8 +150,7 @@ def get_umbrella_clients(incoming_msg, rettype):
     '''
 
     # Get client username
-    cmdlist = incoming_msg.text.split(" ")
-    client_id = cmdlist[len(cmdlist)-1]
+    client_id = cico_common.get_client_id(incoming_msg)
 
     # Parse logs to get relevant data
     logdata = parse_umbrella_logs()
@@ -0,0 +1,345 @@
+'''
+    This module is specifically for scheduling requests to the Meraki Dashboard API. The Dashboard API enforces a
+    per-organization rate limit, so each organization has its own priority queue and token bucket. A fixed number of
+    worker threads issue the requests; each worker takes the highest priority request from any organization whose
+    bucket has a token, so a large backlog for one organization does not hold up the others. Interactive requests (a
+    user is waiting on the bot) are issued ahead of background refreshes. A 429 response pauses the whole organization for the
+    time given in the Retry-After header, and the request is queued again.
+'''
+import os
+import time
+import heapq
+import queue
+import itertools
+import threading
+import requests
+
+# ========================================================
+# Load required parameters from environment variables
+# ========================================================
+
+meraki_api_rate = os.getenv("MERAKI_API_RATE")
+if not meraki_api_rate:
+    meraki_api_rate = "5"
+meraki_api_concurrency = os.getenv("MERAKI_API_CONCURRENCY")
+if not meraki_api_concurrency:
+    meraki_api_concurrency = "4"
+meraki_api_retries = os.getenv("MERAKI_API_RETRIES")
+if not meraki_api_retries:
+    meraki_api_retries = "5"
+# Limit across every organization used with the API key (in addition to the per-organization limit). Off by default
+# with a single organization; in multi-organization mode (MERAKI_ORGS) it defaults to the per-organization rate, so
+# polling several organizations at once does not multiply the load on the API key.
+meraki_api_key_rate = os.getenv("MERAKI_API_KEY_RATE")
+if not meraki_api_key_rate and os.getenv("MERAKI_ORGS"):
+    meraki_api_key_rate = meraki_api_rate
+
+# Request priorities. Lower numbers are issued first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Request queue for each organization, keyed by organization id. Each queue is a heap of (priority, sequence, job); the
+# sequence keeps requests of the same priority in the order they were added.
+org_queues = {}
+request_seq = itertools.count()
+# Token bucket for each organization, keyed by organization id. The shared API key bucket is keyed by key_bucket.
+token_buckets = {}
+key_bucket = "*"
+bucket_lock = threading.Lock()
+# Signalled when a job is queued. Uses bucket_lock, so the queues and buckets are always looked at together.
+queue_cond = threading.Condition(bucket_lock)
+worker_threads = []
+worker_lock = threading.Lock()
+# Holds the requests.Session of each worker thread, so connections to the API are kept open and reused
+worker_local = threading.local()
+scheduler_stats = {"completed": 0, "failed": 0, "retried": 0, "throttled": 0, "cancelled": 0, "in_flight": 0}
+stats_lock = threading.Lock()
+
+# ========================================================
+# Initialize Program - Function Definitions
+# ========================================================
+
+
+def count_stat(statname, val):
+    '''
+    Adjusts one of the scheduler statistics
+
+    :param statname: String. Name of the statistic
+    :param val: Integer. Amount to add
+    :return: Nothing
+    '''
+    with stats_lock:
+        scheduler_stats[statname] += val
+
+
+def get_bucket_rate(org):
+    '''
+    Returns the number of requests per second allowed for a token bucket
+
+    :param org: String. Organization id, or key_bucket for the shared API key bucket
+    :return: Float. Requests per second
+    '''
+    if org == key_bucket:
+        return float(meraki_api_key_rate)
+    return float(meraki_api_rate)
+
+
+def get_bucket(org):
+    '''
+    Returns the token bucket for an organization, creating a full one if needed. Must be called with bucket_lock held.
+
+    :param org: String. Organization id
+    :return: Dictionary. The token bucket
+    '''
+    if org not in token_buckets:
+        token_buckets[org] = {"tokens": get_bucket_rate(org), "updated": time.time(), "blocked_until": 0,
+                              "throttled": 0}
+    return token_buckets[org]
+
+
+def get_bucket_wait(org, now):
+    '''
+    Refills a token bucket, and works out how long it will be until it has a token available. Must be called with
+    bucket_lock held.
+
+    :param org: String. Organization id, or key_bucket for the shared API key bucket
+    :param now: Float. The current time
+    :return: Float. Number of seconds until a token is available (0 if one is available now)
+    '''
+    bucket = get_bucket(org)
+    rate = get_bucket_rate(org)
+    if now < bucket["blocked_until"]:
+        return bucket["blocked_until"] - now
+    bucket["tokens"] = min(rate, bucket["tokens"] + (now - bucket["updated"]) * rate)
+    bucket["updated"] = now
+    if bucket["tokens"] < 1:
+        return (1 - bucket["tokens"]) / rate
+    return 0
+
+
+def next_job():
+    '''
+    Waits until a queued job can be issued, and takes it off its queue along with a token from its organization's
+    bucket (and the shared API key bucket, if there is a key-wide limit). Of the organizations that have a token
+    available, the highest priority job is taken. Jobs whose batch has been cancelled are dropped without using a token.
+
+    :return: Dictionary. The job to run
+    '''
+    with queue_cond:
+        while True:
+            now = time.time()
+            keywait = 0
+            if meraki_api_key_rate:
+                keywait = get_bucket_wait(key_bucket, now)
+            bestorg = None
+            wait = None
+            for org in list(org_queues):
+                orgqueue = org_queues[org]
+                # The caller has stopped waiting for these, so don't spend a token on them
+                while orgqueue and orgqueue[0][2]["batch"]["cancelled"]:
+                    heapq.heappop(orgqueue)
+                    count_stat("cancelled", 1)
+                if not orgqueue:
+                    del org_queues[org]
+                    continue
+                orgwait = max(keywait, get_bucket_wait(org, now))
+                if orgwait == 0:
+                    if bestorg is None or orgqueue[0] < org_queues[bestorg][0]:
+                        bestorg = org
+                elif wait is None or orgwait < wait:
+                    wait = orgwait
+
+            if bestorg is not None:
+                priority, seq, job = heapq.heappop(org_queues[bestorg])
+                token_buckets[bestorg]["tokens"] -= 1
+                if meraki_api_key_rate:
+                    token_buckets[key_bucket]["tokens"] -= 1
+                return job
+            # Nothing can be issued yet. Wait for the first bucket to refill, or for another job to be queued.
+            queue_cond.wait(wait)
+
+
+def throttle_org(org, seconds):
+    '''
+    Pauses all requests for an organization, after the Dashboard API has told us to slow down
+
+    :param org: String. Organization id
+    :param seconds: Float. Number of seconds to pause for
+    :return: Nothing
+    '''
+    with bucket_lock:
+        bucket = get_bucket(org)
+        bucket["blocked_until"] = max(bucket["blocked_until"], time.time() + seconds)
+        bucket["tokens"] = 0
+        bucket["throttled"] += 1
+
+
+def get_retry_after(resp):
+    '''
+    Reads the Retry-After header of a 429 response
+
+    :param resp: Response. The 429 response
+    :return: Float. Number of seconds to wait, or 1 if the header is missing or not a number of seconds
+    '''
+    try:
+        return float(resp.headers.get("Retry-After", 1))
+    except ValueError:
+        return 1.0
+
+
+def queue_job(job):
+    '''
+    Adds a job to the request queue
+
+    :param job: Dictionary. The job to add
+    :return: Nothing
+    '''
+    with queue_cond:
+        if job["org"] not in org_queues:
+            org_queues[job["org"]] = []
+        heapq.heappush(org_queues[job["org"]], (job["priority"], job["seq"], job))
+        queue_cond.notify()
+
+
+def get_session():
+    '''
+    Returns the requests.Session of the calling worker thread, creating it the first time. A session is not shared
+    between threads, so each worker has its own pool of connections.
+
+    :return: requests.Session
+    '''
+    if not hasattr(worker_local, "session"):
+        worker_local.session = requests.Session()
+    return worker_local.session
+
+
+def run_job(job):
+    '''
+    Issues the request for a single job, once next_job has taken a token for it. The response is handed back to the
+    batch the job belongs to, unless the request needs to be tried again.
+
+    :param job: Dictionary. The job to run
+    :return: Nothing
+    '''
+    # The caller has stopped waiting for this batch since the job was taken off the queue
+    if job["batch"]["cancelled"]:
+        count_stat("cancelled", 1)
+        return
+    count_stat("in_flight", 1)
+    try:
+        resp = get_session().get(job["url"], headers=job["headers"], timeout=30)
+    except requests.exceptions.RequestException as e:
+        print("Error retrieving", job["url"], e)
+        resp = None
+    count_stat("in_flight", -1)
+
+    job["attempt"] += 1
+    if resp is not None and resp.status_code == 429:
+        # Rate limited. Pause the whole organization for as long as we were asked to, then try again.
+        count_stat("throttled", 1)
+        throttle_org(job["org"], get_retry_after(resp))
+        if job["attempt"] <= int(meraki_api_retries):
+            queue_job(job)
+            return
+    elif resp is None or resp.status_code >= 500:
+        # Server side problem. Back off exponentially, then try again.
+        if job["attempt"] <= int(meraki_api_retries):
+            count_stat("retried", 1)
+            threading.Timer(0.5 * (2 ** (job["attempt"] - 1)), queue_job, [job]).start()
+            return
+
+    if resp is not None and resp.status_code == 200:
+        count_stat("completed", 1)
+    else:
+        count_stat("failed", 1)
+    job["results"].put(resp)
+
+
+def worker_loop():
+    '''
+    Main loop of a worker thread. Takes the next job that can be issued (see next_job) and runs it.
+
+    :return: Nothing
+    '''
+    while True:
+        job = next_job()
+        try:
+            run_job(job)
+        except Exception as e:
+            print("Error running Meraki API request", job["url"], e)
+            job["results"].put(None)
+
+
+def start_workers():
+    '''
+    Starts the worker threads, if they have not been started already
+
+    :return: Nothing
+    '''
+    with worker_lock:
+        while len(worker_threads) < int(meraki_api_concurrency):
+            t = threading.Thread(target=worker_loop, daemon=True)
+            t.start()
+            worker_threads.append(t)
+
+
+def multi_get(url_list, headers, org, priority):
+    '''
+    Issues GET requests to a list of URLs through the scheduler, and returns the responses as they complete. Requests
+    that still fail after retrying are not returned.
+
+    :param url_list: List. List of URLs to issue GET requests to
+    :param headers: Dictionary. Headers to send with each request
+    :param org: String. Organization id; used to select the token bucket
+    :param priority: Integer. PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND
+    :return: Generator. Each successful (200 OK) response, in the order they complete. Requests are issued in the
+             order of url_list. Closing the generator early cancels any requests that have not been issued yet.
+    '''
+    start_workers()
+    results = queue.Queue()
+    batch = {"cancelled": False}
+    for u in url_list:
+        queue_job({"url": u, "headers": headers, "org": org, "priority": priority, "seq": next(request_seq),
+                   "attempt": 0, "results": results, "batch": batch})
+
+    try:
+        for x in range(0, len(url_list)):
+            resp = results.get()
+            if resp is not None and resp.status_code == 200:
+                yield resp
+    finally:
+        batch["cancelled"] = True
+
+
+def get(url, headers, org, priority):
+    '''
+    Issues a single GET request through the scheduler, and waits for it to complete
+
+    :param url: String. URL to issue the GET request to
+    :param headers: Dictionary. Headers to send with the request
+    :param org: String. Organization id; used to select the token bucket
+    :param priority: Integer. PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND
+    :return: Response. The response (which may be an error), or None if the request could not be made
+    '''
+    start_workers()
+    results = queue.Queue()
+    queue_job({"url": url, "headers": headers, "org": org, "priority": priority, "seq": next(request_seq),
+               "attempt": 0, "results": results, "batch": {"cancelled": False}})
+    return results.get()
+
+
+def get_scheduler_stats():
+    '''
+    Returns the current state of the scheduler
+
+    :return: Dictionary. Queue depth, request counters, and the number of times each organization was throttled
+    '''
+    with stats_lock:
+        stats = dict(scheduler_stats)
+    with bucket_lock:
+        stats["queue_depth"] = sum(len(orgqueue) for orgqueue in org_queues.values())
+        stats["orgs"] = {}
+        for org in token_buckets:
+            stats["orgs"][org] = {"throttled": token_buckets[org]["throttled"],
+                                  "paused": max(0, int(token_buckets[org]["blocked_until"] - time.time()))}
+    return stats
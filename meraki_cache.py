@@ -0,0 +1,270 @@
+'''
+    This module is specifically for caching Meraki Dashboard API data in memory. Data is grouped into tiers, and each
+    tier has its own time-to-live (TTL). Data that rarely changes (networks, device inventory) can be kept longer than
+    data that changes often (device statuses). A background job keeps the tiers warm, so bot commands are answered
+    from memory instead of waiting on the Dashboard API.
+'''
+import os
+import time
+import threading
+import concurrent.futures
+
+# ========================================================
+# Load required parameters from environment variables
+# ========================================================
+
+meraki_cache_network_ttl = os.getenv("MERAKI_CACHE_NETWORK_TTL")
+if not meraki_cache_network_ttl:
+    meraki_cache_network_ttl = "3600"
+meraki_cache_device_ttl = os.getenv("MERAKI_CACHE_DEVICE_TTL")
+if not meraki_cache_device_ttl:
+    meraki_cache_device_ttl = "3600"
+meraki_cache_status_ttl = os.getenv("MERAKI_CACHE_STATUS_TTL")
+if not meraki_cache_status_ttl:
+    meraki_cache_status_ttl = "60"
+meraki_cache_client_ttl = os.getenv("MERAKI_CACHE_CLIENT_TTL")
+if not meraki_cache_client_ttl:
+    meraki_cache_client_ttl = "300"
+meraki_cache_sm_ttl = os.getenv("MERAKI_CACHE_SM_TTL")
+if not meraki_cache_sm_ttl:
+    meraki_cache_sm_ttl = "900"
+meraki_cache_uplink_ttl = os.getenv("MERAKI_CACHE_UPLINK_TTL")
+if not meraki_cache_uplink_ttl:
+    meraki_cache_uplink_ttl = "300"
+meraki_cache_refresh = os.getenv("MERAKI_CACHE_REFRESH")
+if not meraki_cache_refresh:
+    meraki_cache_refresh = "30"
+
+# Dictionary of all registered tiers, keyed by tier name
+cache_tiers = {}
+# Set to True once the background refresher has been scheduled. Until then, stale tiers are refreshed on demand.
+refresher_active = False
+
+# ========================================================
+# Initialize Program - Function Definitions
+# ========================================================
+
+
+def org_tier_name(tiername, org):
+    '''
+    Returns the name a tier is registered under for an organization
+
+    :param tiername: String. Name of the tier, eg 'networks'
+    :param org: String. Organization id, or None for the single organization (the tier name is used as-is)
+    :return: String. The name of the tier for the organization, eg 'networks@12345'
+    '''
+    if org is None:
+        return tiername
+    return tiername + "@" + str(org)
+
+
+def register_tier(tiername, ttl, loader, group=None, slow=False):
+    '''
+    Registers a cache tier. Nothing is loaded here; the tier is populated the first time it is requested, or by the
+    background refresher.
+
+    :param tiername: String. Name of the tier, eg 'networks'
+    :param ttl: String or Integer. Number of seconds the data in this tier is considered fresh
+    :param loader: Function. Called with no arguments to (re)load the data for this tier
+    :param group: String. (optional) Group the tier belongs to (eg an organization id). Groups are refreshed in
+                  parallel by the background refresher.
+    :param slow: Boolean. (optional) True for tiers that take a long time to load (a fan-out to every device or
+                 network). These are refreshed by a separate background job, so they do not hold up the other tiers.
+    :return: Nothing
+    '''
+    cache_tiers[tiername] = {"ttl": int(ttl), "loader": loader, "data": None, "updated": 0, "version": 0,
+                             "lock": threading.Lock(), "sources": None, "source_versions": None, "group": group,
+                             "slow": slow}
+
+
+def register_derived_tier(tiername, sources, builder, group=None, slow=False):
+    '''
+    Registers a tier that is built from other tiers (for example, an index). A derived tier has no TTL of its own; it
+    is rebuilt once each time one of its source tiers is refreshed.
+
+    :param tiername: String. Name of the tier, eg 'inventory'
+    :param sources: List. Names of the tiers this tier is built from
+    :param builder: Function. Called with no arguments to build the data for this tier
+    :param group: String. (optional) Group the tier belongs to, see register_tier
+    :param slow: Boolean. (optional) True if the tier is built from slow tiers, see register_tier
+    :return: Nothing
+    '''
+    register_tier(tiername, 0, builder, group, slow)
+    cache_tiers[tiername]["sources"] = sources
+
+
+def refresh_tier(tiername):
+    '''
+    Reloads a single tier. If the loader fails, the previous data is retained so that a Dashboard API problem does not
+    empty the cache.
+
+    :param tiername: String. Name of the tier to refresh
+    :return: The data held by the tier after the refresh
+    '''
+    tier = cache_tiers[tiername]
+    # Only one thread should be loading a given tier at a time. If another thread got here first, wait for it and use
+    # what it loaded.
+    startver = tier["version"]
+    with tier["lock"]:
+        if tier["version"] != startver:
+            return tier["data"]
+        try:
+            newdata = tier["loader"]()
+        except Exception as e:
+            print("Error refreshing Meraki cache tier '" + tiername + "':", e)
+            return tier["data"]
+        tier["data"] = newdata
+        tier["updated"] = time.time()
+        tier["version"] += 1
+        if tier["sources"]:
+            tier["source_versions"] = [cache_tiers[t]["version"] for t in tier["sources"]]
+    return tier["data"]
+
+
+def update_tier(tiername, updater):
+    '''
+    Applies a change to the data held by a tier in place (for example, a single device status from a webhook alert).
+    The tier keeps its load time, so it is still fully reloaded when its TTL runs out, but its version changes so that
+    tiers derived from it are rebuilt. Nothing is done if the tier has not been loaded yet.
+
+    :param tiername: String. Name of the tier
+    :param updater: Function. Called with the tier data, while no other thread is loading the tier
+    :return: Nothing
+    '''
+    tier = cache_tiers[tiername]
+    with tier["lock"]:
+        if tier["data"] is not None:
+            updater(tier["data"])
+            tier["version"] += 1
+
+
+def set_tier_ttl(tiername, ttl):
+    '''
+    Changes the TTL of a tier, for example when another source keeps the tier up to date between reloads
+
+    :param tiername: String. Name of the tier
+    :param ttl: String or Integer. Number of seconds the data in this tier is considered fresh
+    :return: Nothing
+    '''
+    cache_tiers[tiername]["ttl"] = int(ttl)
+
+
+def tier_is_stale(tiername):
+    '''
+    Checks whether a tier has outlived its TTL (or has never been loaded)
+
+    :param tiername: String. Name of the tier
+    :return: true/false based on whether the tier needs to be refreshed
+    '''
+    tier = cache_tiers[tiername]
+    if tier["sources"]:
+        return tier["data"] is None or tier["source_versions"] != [cache_tiers[t]["version"] for t in tier["sources"]]
+    return tier["data"] is None or time.time() - tier["updated"] >= tier["ttl"]
+
+
+def get_tier(tiername):
+    '''
+    Returns the data for a tier. A tier that has never been loaded is loaded now. A stale tier is returned as-is when
+    the background refresher is running (it will be replaced shortly), and reloaded now otherwise. A derived tier is
+    rebuilt if any of its sources have been refreshed since it was last built.
+
+    :param tiername: String. Name of the tier
+    :return: The cached data for the tier
+    '''
+    tier = cache_tiers[tiername]
+    if tier["sources"]:
+        # Make sure the sources are loaded first, so the staleness check below compares the right versions
+        for t in tier["sources"]:
+            get_tier(t)
+        if tier_is_stale(tiername):
+            return refresh_tier(tiername)
+    elif tier["data"] is None or (not refresher_active and tier_is_stale(tiername)):
+        return refresh_tier(tiername)
+    return tier["data"]
+
+
+def peek_tier(tiername):
+    '''
+    Returns the data for a tier without loading it. Used for tiers that are too expensive to load while a user is
+    waiting; these are left to the background refresher.
+
+    :param tiername: String. Name of the tier
+    :return: The cached data for the tier, or None if it has not been loaded yet
+    '''
+    return cache_tiers[tiername]["data"]
+
+
+def get_tier_version(tiername):
+    '''
+    Returns the version of a tier, which changes each time its data is reloaded or updated
+
+    :param tiername: String. Name of the tier
+    :return: Integer. Version of the tier data (0 if it has never been loaded)
+    '''
+    return cache_tiers[tiername]["version"]
+
+
+def get_tier_age(tiername):
+    '''
+    Number of seconds since a tier was last loaded
+
+    :param tiername: String. Name of the tier
+    :return: Integer. Age of the tier data in seconds
+    '''
+    return int(time.time() - cache_tiers[tiername]["updated"])
+
+
+def refresh_tier_group(tiernames):
+    '''
+    Reloads every tier in a group that has outlived its TTL, then rebuilds any derived tier whose sources changed
+
+    :param tiernames: List. Names of the tiers in the group, in the order they were registered
+    :return: Nothing
+    '''
+    for tiername in tiernames:
+        if not cache_tiers[tiername]["sources"] and tier_is_stale(tiername):
+            refresh_tier(tiername)
+    for tiername in tiernames:
+        if cache_tiers[tiername]["sources"] and tier_is_stale(tiername):
+            refresh_tier(tiername)
+
+
+def refresh_stale_tiers(slow=False):
+    '''
+    Entry point for the background refresher. Refreshes each group of tiers (see refresh_tier_group); when there is
+    more than one group (organization), the groups are refreshed in parallel. The slow tiers are refreshed by their own
+    background job, so that a long fan-out does not stop the other tiers (eg device statuses) from being refreshed.
+
+    :param slow: Boolean. (optional) pass True to refresh only the slow tiers, False to refresh only the others
+    :return: Nothing
+    '''
+    groups = {}
+    for tiername in list(cache_tiers):
+        if cache_tiers[tiername]["slow"] != slow:
+            continue
+        group = cache_tiers[tiername]["group"]
+        if group in groups:
+            groups[group].append(tiername)
+        else:
+            groups[group] = [tiername]
+
+    if len(groups) <= 1:
+        for tiernames in groups.values():
+            refresh_tier_group(tiernames)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as pool:
+        list(pool.map(refresh_tier_group, groups.values()))
+
+
+def format_age(tiernames, label="Data"):
+    '''
+    Builds a staleness indicator for a bot reply, based on the oldest of the given tiers
+
+    :param tiernames: List. Names of the tiers to report the age of
+    :param label: String. (optional) What the data is, eg 'Device status'
+    :return: String. Human readable description of the age of the data
+    '''
+    age = max(get_tier_age(t) for t in tiernames)
+    if age < 60:
+        return label + " as of " + str(age) + " second(s) ago."
+    return label + " as of " + str(age // 60) + " minute(s) ago."
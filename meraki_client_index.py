@@ -0,0 +1,270 @@
+'''
+    This module is specifically for the Meraki client location index. The index is an inverted index from client
+    description, DHCP hostname and MAC address to the place the client was last seen (network, device, switchport).
+    It is built in the background, so that a user check only has to confirm the location(s) found in the index rather
+    than asking every device in the organization for its clients. Clients can also be looked up by IP address / CIDR
+    range (using a sorted list of client IP addresses) and by MAC address prefix (using a prefix trie). The module
+    also remembers where recently checked users were found, so those devices can be asked first.
+'''
+import os
+import re
+import bisect
+import functools
+import ipaddress
+import threading
+import collections
+
+# ========================================================
+# Load required parameters from environment variables
+# ========================================================
+
+meraki_client_hints = os.getenv("MERAKI_CLIENT_HINTS")
+if not meraki_client_hints:
+    meraki_client_hints = "1000"
+
+# The client fields that the index is keyed on
+index_fields = ["description", "dhcpHostname", "mac"]
+# A partial or full MAC address of at least an OUI (3 octets), written as 00:18:0a / 00-18-0a, Cisco style as
+# 0018.0a, or unseparated as 00180a. Unseparated prefixes must contain a digit, so names such as "facade" are not taken
+# for MAC addresses.
+mac_prefix_re = re.compile(r"^([0-9a-f]{2}([:-][0-9a-f]{2}){2,5}"
+                           r"|[0-9a-f]{4}\.[0-9a-f]{2,4}|[0-9a-f]{4}\.[0-9a-f]{4}\.[0-9a-f]{1,4}"
+                           r"|(?=[a-f]*[0-9])[0-9a-f]{6,12})$", re.IGNORECASE)
+# Where each recently checked user was last found, as a list of (networkId, serial). Kept in least recently used
+# order, and trimmed to MERAKI_CLIENT_HINTS users.
+client_hints = collections.OrderedDict()
+hint_lock = threading.Lock()
+
+# ========================================================
+# Initialize Program - Function Definitions
+# ========================================================
+
+
+@functools.lru_cache(maxsize=256)
+def parse_client_query(client_id):
+    '''
+    Works out what kind of client check is being made
+
+    :param client_id: String. The search string given to the client check
+    :return: Tuple. ("ip", (version, first, last)) for an IP address or CIDR range, ("mac", prefix) for a MAC address
+             (prefix), otherwise ("name", client_id)
+    '''
+    if "." in client_id or ":" in client_id or "/" in client_id:
+        try:
+            ipnet = ipaddress.ip_network(client_id, strict=False)
+            return "ip", (ipnet.version, int(ipnet.network_address), int(ipnet.broadcast_address))
+        except ValueError:
+            pass
+    if mac_prefix_re.match(client_id):
+        return "mac", normalize_mac(client_id)
+    return "name", client_id
+
+
+def normalize_mac(mac):
+    '''
+    Converts a MAC address (or prefix) to lowercase hex digits, with no separators
+
+    :param mac: String. MAC address
+    :return: String. Normalized MAC address
+    '''
+    return mac.lower().replace(":", "").replace("-", "").replace(".", "")
+
+
+def get_ip_key(ipstr):
+    '''
+    Converts a client IP address into a sortable key
+
+    :param ipstr: String. IP address
+    :return: Tuple. (version, integer value), or None if this is not an IP address
+    '''
+    try:
+        ipaddr = ipaddress.ip_address(ipstr)
+    except ValueError:
+        return None
+    return ipaddr.version, int(ipaddr)
+
+
+def build_client_index(netlist):
+    '''
+    Builds the client location index from the result of a client fan-out
+
+    :param netlist: Dictionary. Result of do_multi_get for /devices/{serial}/clients, in the form
+                    {networkId: {"devices": {serial: {"clients": [...]}}}}
+    :return: Dictionary. {field: {value: [location, ...]}} for each field in index_fields. A location is a dictionary
+             with networkId, serial and switchport. Also "ip_keys" / "ip_locs", the client IP addresses in sorted order
+             with their locations, and "mac_trie", a trie of normalized MAC addresses (one level per hex digit) with
+             the locations under the "" key of the last level.
+    '''
+    index = {}
+    for field in index_fields:
+        index[field] = {}
+    iplist = []
+    mac_trie = {}
+
+    for net in netlist:
+        for dev in netlist[net]["devices"]:
+            for cli in netlist[net]["devices"][dev]["clients"]:
+                # The client should not be a string. If it is for some reason, do not index it.
+                if isinstance(cli, str):
+                    continue
+                loc = {"networkId": net, "serial": dev, "switchport": cli.get("switchport")}
+                for field in index_fields:
+                    val = cli.get(field)
+                    if val:
+                        if val in index[field]:
+                            index[field][val].append(loc)
+                        else:
+                            index[field][val] = [loc]
+                ipkey = get_ip_key(cli.get("ip") or "")
+                if ipkey:
+                    iplist.append((ipkey, loc))
+                if cli.get("mac"):
+                    node = mac_trie
+                    for digit in normalize_mac(cli["mac"]):
+                        node = node.setdefault(digit, {})
+                    node.setdefault("", []).append(loc)
+
+    # Sort the IP addresses once, so a range of addresses can be found with a binary search
+    iplist.sort(key=lambda ip: ip[0])
+    index["ip_keys"] = [ip[0] for ip in iplist]
+    index["ip_locs"] = [ip[1] for ip in iplist]
+    index["mac_trie"] = mac_trie
+
+    return index
+
+
+def lookup_client_ip(index, version, first, last):
+    '''
+    Finds the locations of clients with an IP address in a range
+
+    :param index: Dictionary. Index from build_client_index
+    :param version: Integer. IP version (4 or 6)
+    :param first: Integer. First address of the range
+    :param last: Integer. Last address of the range
+    :return: List. Locations of the matching clients
+    '''
+    lo = bisect.bisect_left(index["ip_keys"], (version, first))
+    hi = bisect.bisect_right(index["ip_keys"], (version, last))
+    return index["ip_locs"][lo:hi]
+
+
+def lookup_client_mac_prefix(index, prefix):
+    '''
+    Finds the locations of clients whose MAC address starts with a prefix
+
+    :param index: Dictionary. Index from build_client_index
+    :param prefix: String. Normalized MAC address prefix
+    :return: List. Locations of the matching clients
+    '''
+    node = index["mac_trie"]
+    for digit in prefix:
+        if digit not in node:
+            return []
+        node = node[digit]
+
+    found = []
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        for digit in node:
+            if digit == "":
+                found += node[digit]
+            else:
+                nodes.append(node[digit])
+    return found
+
+
+def lookup_client_index(index, client_id, macs):
+    '''
+    Looks up the locations of a client in the index
+
+    :param index: Dictionary. Index from build_client_index
+    :param client_id: String. Client username (matched against description and DHCP hostname), IP address, CIDR
+                      range or MAC address prefix
+    :param macs: List. Additional MAC addresses to locate (for example, the user's phones)
+    :return: List. Unique (networkId, serial) tuples where the client or MAC addresses were seen
+    '''
+    locations = []
+    querytype, queryval = parse_client_query(client_id)
+    if querytype == "ip":
+        found = lookup_client_ip(index, *queryval)
+    elif querytype == "mac":
+        found = lookup_client_mac_prefix(index, queryval)
+    else:
+        found = index["description"].get(client_id, []) + index["dhcpHostname"].get(client_id, [])
+    for mac in macs:
+        for loc in index["mac"].get(mac, []):
+            found.append(loc)
+
+    for loc in found:
+        thisloc = (loc["networkId"], loc["serial"])
+        if thisloc not in locations:
+            locations.append(thisloc)
+
+    return locations
+
+
+def client_query_matches(cli, client_id):
+    '''
+    Checks whether a client is the one a client check is looking for: by description for a username, by address for
+    an IP address or CIDR range, or by prefix for a MAC address
+
+    :param cli: Dictionary. The client
+    :param client_id: String. The search string given to the client check
+    :return: true/false based on whether the client matches
+    '''
+    querytype, queryval = parse_client_query(client_id)
+    if querytype == "ip":
+        ipkey = get_ip_key(cli.get("ip") or "")
+        return ipkey is not None and ipkey[0] == queryval[0] and queryval[1] <= ipkey[1] <= queryval[2]
+    if querytype == "mac":
+        return normalize_mac(cli.get("mac") or "").startswith(queryval)
+    return cli.get("description") == client_id
+
+
+def client_matches(cli, client_id, macs):
+    '''
+    Checks a single client against a client check. The user is matched the same way the check shows them (see
+    client_query_matches), so a search does not stop early on a client that will not be shown.
+
+    :param cli: Dictionary. The client
+    :param client_id: String. Client username (matched against description), IP address, CIDR range or MAC address
+                      prefix
+    :param macs: List. Additional MAC addresses to match (for example, the user's phones)
+    :return: true/false based on whether the client matches
+    '''
+    # The client should not be a string. If it is for some reason, it does not match.
+    if isinstance(cli, str):
+        return False
+    return client_query_matches(cli, client_id) or cli.get("mac") in macs
+
+
+def remember_client_locations(client_id, locations):
+    '''
+    Records where a user was found by a client check
+
+    :param client_id: String. Client username
+    :param locations: List. (networkId, serial) tuples where the user was found
+    :return: Nothing
+    '''
+    if not locations:
+        return
+    with hint_lock:
+        client_hints[client_id] = list(locations)
+        client_hints.move_to_end(client_id)
+        while len(client_hints) > int(meraki_client_hints):
+            client_hints.popitem(last=False)
+
+
+def get_client_hints(client_id):
+    '''
+    Returns where a user was last found by a client check
+
+    :param client_id: String. Client username
+    :return: List. (networkId, serial) tuples, or an empty list if the user has not been found before
+    '''
+    with hint_lock:
+        if client_id not in client_hints:
+            return []
+        client_hints.move_to_end(client_id)
+        return list(client_hints[client_id])
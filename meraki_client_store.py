@@ -0,0 +1,174 @@
+'''
+    This module is specifically for the Meraki client store. The store keeps the clients seen on each device over the
+    configured client timespan (MERAKI_CLIENT_TIMESPAN). Rather than downloading the whole timespan on every refresh,
+    each device is only asked for the clients seen since it was last polled, and the result is merged into the store.
+    Clients that have not been seen within the timespan are aged out. Each organization has its own part of the store,
+    so polling or aging out one organization does not touch the others.
+'''
+import os
+import time
+import threading
+import meraki_records
+
+# ========================================================
+# Load required parameters from environment variables
+# ========================================================
+
+meraki_client_poll_margin = os.getenv("MERAKI_CLIENT_POLL_MARGIN")
+if not meraki_client_poll_margin:
+    meraki_client_poll_margin = "60"
+
+# Dictionary of organizations, keyed by organization id. Each organization has a dictionary of devices, keyed by serial.
+# Each device entry has the networkId and info of the device, the time it was last polled, and its clients (keyed by
+# client id) along with the time each client was last seen.
+client_store = {}
+store_lock = threading.Lock()
+
+# ========================================================
+# Initialize Program - Function Definitions
+# ========================================================
+
+
+def get_org_store(org):
+    '''
+    Returns the devices in the store for an organization, creating an empty entry if needed. Must be called with
+    store_lock held.
+
+    :param org: String. Organization id
+    :return: Dictionary. The organization's devices, keyed by serial
+    '''
+    if org not in client_store:
+        client_store[org] = {}
+    return client_store[org]
+
+
+def get_poll_timespan(org, serial, maxspan):
+    '''
+    Works out how far back a device needs to be asked for clients. A device that has never been polled is asked for
+    the whole timespan; otherwise it is asked for the time since its last poll (plus a small margin for overlap).
+
+    :param org: String. Organization id
+    :param serial: String. Serial number of the device
+    :param maxspan: Integer. The configured client timespan, in seconds
+    :return: Integer. Timespan to poll, in seconds
+    '''
+    with store_lock:
+        orgstore = get_org_store(org)
+        if serial not in orgstore or not orgstore[serial]["polled"]:
+            return maxspan
+        span = int(time.time() - orgstore[serial]["polled"]) + int(meraki_client_poll_margin)
+    return min(span, maxspan)
+
+
+def get_client_key(cli):
+    '''
+    Returns the key a client is stored under
+
+    :param cli: Dictionary. The client
+    :return: String. The client id, or the mac address if the client has no id
+    '''
+    if cli.get("id"):
+        return cli["id"]
+    return cli["mac"]
+
+
+def get_seen_time(cli, polltime, span):
+    '''
+    Works out when a client was last seen. Network clients have a lastSeen time. Device clients do not, so all that is
+    known is that the client was seen at some point during the poll's timespan; the middle of the timespan is used.
+    For the usual poll (the time since the previous poll) this is within a minute or so. For a device's first poll,
+    which covers the whole of MERAKI_CLIENT_TIMESPAN, a client that is not seen again is aged out between 0.5x and 1.5x
+    MERAKI_CLIENT_TIMESPAN after it was really last seen, rather than up to 2x if it were stamped with the poll time.
+
+    :param cli: Dictionary. The client, as returned by the Dashboard API
+    :param polltime: Float. The time the poll was started
+    :param span: Integer. The timespan the poll covered, in seconds
+    :return: Float. The time the client was last seen
+    '''
+    lastseen = cli.get("lastSeen")
+    if isinstance(lastseen, (int, float)) and not isinstance(lastseen, bool):
+        return min(float(lastseen), polltime)
+    return polltime - span / 2
+
+
+def merge_clients(org, netlist, polltime, spans):
+    '''
+    Merges the result of a client poll into the store. Only the fields the bot uses are kept for each client (see
+    meraki_records.ClientRecord).
+
+    :param org: String. Organization id
+    :param netlist: Dictionary. Result of do_multi_get for /devices/{serial}/clients, in the form
+                    {networkId: {"devices": {serial: {"info": device, "clients": [...]}}}}
+    :param polltime: Float. The time the poll was started
+    :param spans: Dictionary. The timespan each device was polled for, in seconds, keyed by serial
+    :return: Nothing
+    '''
+    with store_lock:
+        orgstore = get_org_store(org)
+        for net in netlist:
+            for dev in netlist[net]["devices"]:
+                devbase = netlist[net]["devices"][dev]
+                if dev not in orgstore:
+                    orgstore[dev] = {"networkId": net, "info": devbase["info"], "polled": 0, "clients": {},
+                                     "seen": {}}
+                store = orgstore[dev]
+                store["networkId"] = net
+                store["info"] = devbase["info"]
+                store["polled"] = polltime
+                for cli in devbase["clients"]:
+                    # The client should not be a string. If it is for some reason, do not store it.
+                    if not isinstance(cli, str):
+                        ckey = get_client_key(cli)
+                        store["clients"][ckey] = meraki_records.ClientRecord(cli)
+                        # Keep the most recent time the client is known to have been seen
+                        seen = get_seen_time(cli, polltime, spans.get(dev, 0))
+                        store["seen"][ckey] = max(seen, store["seen"].get(ckey, seen))
+
+
+def age_out_clients(org, maxspan, serials):
+    '''
+    Removes clients that have not been seen within the timespan, and devices that are no longer in the organization
+
+    :param org: String. Organization id
+    :param maxspan: Integer. The configured client timespan, in seconds
+    :param serials: Dictionary or List. Serial numbers of all devices currently in the organization. If this is empty
+                    (the inventory did not load), no devices are removed; their clients are still aged out.
+    :return: Nothing
+    '''
+    cutoff = time.time() - maxspan
+    with store_lock:
+        orgstore = get_org_store(org)
+        for dev in list(orgstore):
+            if serials and dev not in serials:
+                del orgstore[dev]
+                continue
+            store = orgstore[dev]
+            for ckey in [k for k in store["seen"] if store["seen"][k] < cutoff]:
+                del store["clients"][ckey]
+                del store["seen"][ckey]
+
+
+def get_store_netlist(org, serials):
+    '''
+    Returns the clients in the store for an organization, in the same form as the result of a client fan-out with
+    do_multi_get
+
+    :param org: String. Organization id
+    :param serials: List. (optional) pass None to include every device of the organization. Otherwise, only these
+                    devices are included.
+    :return: Dictionary. {networkId: {"info": ..., "devices": {serial: {"info": device, "clients": [...]}}}}
+    '''
+    netlist = {}
+    with store_lock:
+        orgstore = get_org_store(org)
+        if serials is None:
+            serials = list(orgstore)
+        for dev in serials:
+            if dev not in orgstore:
+                continue
+            store = orgstore[dev]
+            if store["networkId"] not in netlist:
+                netlist[store["networkId"]] = {"info": {}, "devices": {}}
+            netlist[store["networkId"]]["devices"][dev] = {"info": store["info"],
+                                                           "clients": list(store["clients"].values())}
+    return netlist
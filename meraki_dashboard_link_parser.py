@@ -5,12 +5,14 @@
 '''
 
 import cico_meraki
+import meraki_cache
 import requests
 import os
 import json
 import sys
 import urllib
 import time
+import hashlib
 
 # ========================================================
 # Load required parameters from environment variables
@@ -19,11 +21,23 @@ import time
 meraki_http_un = os.getenv("MERAKI_HTTP_USERNAME")
 meraki_http_pw = os.getenv("MERAKI_HTTP_PASSWORD")
 meraki_api_token = os.getenv("MERAKI_API_TOKEN")
-meraki_org = os.getenv("MERAKI_ORG")
-if not meraki_org:
-    meraki_org = cico_meraki.get_meraki_one_org()
-
-if not meraki_http_un or not meraki_http_pw or not meraki_api_token or not meraki_org:
+meraki_dashboard_map_file = os.getenv("MERAKI_DASHBOARD_MAP_FILE")
+if not meraki_dashboard_map_file:
+    meraki_dashboard_map_file = "/tmp/meraki_dashboard_map.json"
+meraki_dashboard_map_ttl = os.getenv("MERAKI_DASHBOARD_MAP_TTL")
+if not meraki_dashboard_map_ttl:
+    meraki_dashboard_map_ttl = "86400"
+meraki_dashboard_reconcile = os.getenv("MERAKI_DASHBOARD_RECONCILE")
+if not meraki_dashboard_reconcile:
+    meraki_dashboard_reconcile = "900"
+
+# Networks and devices that were still missing from the dashboard after the last re-scrape. They will not trigger
+# another re-scrape (they may simply not be visible to the dashboard user).
+unresolved_entries = {"networks": set(), "devices": set()}
+
+# The organization is not required here; if MERAKI_ORG is not set, it is selected the first time it is needed (see
+# cico_meraki.get_meraki_org)
+if not meraki_http_un or not meraki_http_pw or not meraki_api_token:
     print("meraki_dashboard_link_parser.py - Missing Environment Variable.")
     if not meraki_http_un:
         print("MERAKI_HTTP_USERNAME")
@@ -31,8 +45,6 @@ if not meraki_http_un or not meraki_http_pw or not meraki_api_token or not merak
         print("MERAKI_HTTP_PASSWORD")
     if not meraki_api_token:
         print("MERAKI_API_TOKEN")
-    if not meraki_org:
-        print("MERAKI_ORG")
 
 header = {"X-Cisco-Meraki-API-Key": meraki_api_token}
 
@@ -138,31 +150,10 @@ def meraki_www_get_org_list(strcontent):
     return json.dumps(retarr)
 
 
-def get_meraki_org_name():
-    '''
-    This is an API call that will get a list of all organizations that the API key has access to. It will then search
-    the list of organizations for the ID matching the orgid that was specified/derived for the bot, and then return
-    the name of that organization.
-
-    :return: String. The organization name for the specified/derived organization.
-    '''
-
-    # Get a list of all networks associated with the specified organization
-    orgname = ""
-    url = "https://dashboard.meraki.com/api/v0/organizations"
-    netlist = requests.get(url, headers=header)
-    netjson = json.loads(netlist.content.decode("utf-8"))
-    for n in netjson:
-        if str(n["id"]) == str(meraki_org):
-            orgname = n["name"]
-
-    return orgname
-
-
 def get_meraki_org_url(pagecontent):
     '''
     This function will take the Dictionary of organizations coming from meraki_www_get_org_list, and search that for
-    the name of the organization from get_meraki_org_name. When it has found a match, it will return the full URL
+    the name of the organization from cico_meraki.get_meraki_org_name. When it has found a match, it will return the full URL
     for that organization.
 
     :param pagecontent: String. Raw HTML of the organization page.
@@ -171,7 +162,7 @@ def get_meraki_org_url(pagecontent):
 
     orgurl = ""
     olist = json.loads(meraki_www_get_org_list(pagecontent))
-    org_name_find = get_meraki_org_name()
+    org_name_find = cico_meraki.get_meraki_org_name()
     for onum in olist:
         if olist[onum]["name"] == org_name_find:
             orgurl = "https://dashboard.meraki.com/login/org_choose?eid=" + olist[onum]["id"]
@@ -179,26 +170,150 @@ def get_meraki_org_url(pagecontent):
     return orgurl
 
 
-def get_meraki_api_info():
+def build_dashboard_map(rjson, mhost):
     '''
-    Unused?
+    Builds the cross-launch mapping data from the XHR organization data. The nodes (devices) are grouped by network in
+    a single pass first, so building the map takes time linear in the size of the organization.
 
-    :return:
+    :param rjson: Dictionary. XHR organization data, including "networks" and "nodes"
+    :param mhost: String. FQDN of the dashboard shard for this organization
+    :return: Dictionary. Dict of relevant mapping data to create cross-launch links.
     '''
+    mbase = rjson["networks"]
+    outjson = {"networks": {}, "devices": {}}
+
+    # Group the nodes by the id of the network they belong to
+    netnodes = {}
+    for jdev in rjson["nodes"]:
+        ngid = rjson["nodes"][jdev]["ng_id"]
+        if ngid in netnodes:
+            netnodes[ngid].append(rjson["nodes"][jdev])
+        else:
+            netnodes[ngid] = [rjson["nodes"][jdev]]
+
+    # Now, we will iterate the data loaded from the XHR request to generate the mapping data that we need.
+    for jitem in mbase:
+        netbase = "https://" + mhost + "/" + mbase[jitem]["tag"] + "/n/" + mbase[jitem]["eid"]
+        # This generates the link to the network
+        outjson["networks"][mbase[jitem]["name"]] = {"baseurl": netbase + meraki_www_get_path(mbase[jitem]["type"], "")}           #, "id": mbase[jitem]["id"]
 
-    # Get a list of all networks associated with the specified organization
-    netjson = cico_meraki.get_meraki_networks()
-    # Parse list of networks to extract/create URLs needed to get list of devices
-    urlnet = cico_meraki.collect_url_list(netjson, "https://dashboard.meraki.com/api/v0/networks/$1/devices", "id", "", "", "")
-    # Get a list of all devices associated with the networks associated to the organization
-    netlist = cico_meraki.do_multi_get(urlnet, netjson, "id", "", -1, "networkId", "devices")
-    # Get uplink status of devices
-    urlnetup = cico_meraki.collect_url_list(netlist, "https://dashboard.meraki.com/api/v0/networks/$1/devices/$2/uplink", "info", "id", "devices", "serial")
-    netlistup = cico_meraki.do_multi_get(urlnetup, netlist, "devices", "serial", 8, "", "uplinks")
-    # Split network lists up by device type
-    newnetlist = cico_meraki.do_split_networks(netlistup)
+        # This generates the link to the devices in the network
+        for jdev in netnodes.get(mbase[jitem]["id"], []):
+            outjson["devices"][jdev["mac"]] = {"baseurl": netbase + meraki_www_get_path(mbase[jitem]["type"], jdev["id"]), "desc": jdev["name"]}              #mbase[jitem]["id"]          #jdev["serial"]
 
-    return newnetlist
+    return outjson
+
+
+def get_dashboard_map_key():
+    '''
+    The saved dashboard map is only valid for the dashboard user and organization it was built for. This returns a
+    hash of both that is stored alongside the map.
+
+    :return: String. Hash of the dashboard username and organization id
+    '''
+    return hashlib.sha256((str(meraki_http_un) + "/" + str(cico_meraki.get_meraki_org())).encode("utf-8")).hexdigest()
+
+
+def load_dashboard_map_file():
+    '''
+    Loads the dashboard map saved by a previous run, if it is still within MERAKI_DASHBOARD_MAP_TTL
+
+    :return: Dictionary. The saved dashboard map, or None if there is no usable saved map
+    '''
+    try:
+        with open(meraki_dashboard_map_file) as f:
+            mapjson = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if mapjson.get("key") != get_dashboard_map_key():
+        return None
+    if time.time() - mapjson.get("updated", 0) >= int(meraki_dashboard_map_ttl):
+        return None
+    return mapjson["map"]
+
+
+def save_dashboard_map_file(dbmap):
+    '''
+    Saves the dashboard map, so that the next run does not have to log in and scrape the dashboard
+
+    :param dbmap: Dictionary. The dashboard map
+    :return: Nothing
+    '''
+    try:
+        with open(meraki_dashboard_map_file, "w") as f:
+            json.dump({"key": get_dashboard_map_key(), "updated": time.time(), "map": dbmap}, f)
+    except IOError as e:
+        print("Unable to save Meraki dashboard map to", meraki_dashboard_map_file, e)
+
+
+def get_meraki_dashboard_map():
+    '''
+    Returns the dashboard map. A map saved within MERAKI_DASHBOARD_MAP_TTL is used if there is one; otherwise the
+    dashboard is scraped (see get_meraki_http_info) and the result is saved.
+
+    :return: Dictionary. Dict of relevant mapping data to create cross-launch links.
+    '''
+    dbmap = load_dashboard_map_file()
+    if dbmap is not None:
+        print("Loaded Dashboard references from", meraki_dashboard_map_file)
+        return dbmap
+
+    dbmap = get_meraki_http_info()
+    if dbmap:
+        save_dashboard_map_file(dbmap)
+    return dbmap
+
+
+def get_missing_entries(dbmap):
+    '''
+    Compares the API inventory with the dashboard map, to find networks and devices that do not have a cross-launch
+    link yet.
+
+    :param dbmap: Dictionary. The current dashboard map
+    :return: Dictionary. {"networks": set of dashboard network names, "devices": set of device mac addresses}
+    '''
+    inventory = meraki_cache.get_tier(cico_meraki.org_tier("inventory"))
+    if inventory is None:
+        return {"networks": set(), "devices": set()}
+    # Dashboard network names are the split network names (eg 'Network Name - switch') for combined networks
+    expected = {"networks": set(inventory["split_names"].values()), "devices": set(inventory["macs"])}
+    missing = {}
+    for linktype in expected:
+        missing[linktype] = expected[linktype] - set(dbmap.get(linktype, {})) - unresolved_entries[linktype]
+    return missing
+
+
+def reconcile_dashboard_map():
+    '''
+    Background job that keeps the dashboard map in step with the organization. If networks or devices have been added
+    since the map was built, the dashboard is scraped again, and only the missing entries are added to the map.
+
+    :return: Nothing
+    '''
+    dbmap = cico_meraki.meraki_dashboard_map
+    if not dbmap:
+        dbmap = {"networks": {}, "devices": {}}
+    missing = get_missing_entries(dbmap)
+    if not missing["networks"] and not missing["devices"]:
+        return
+
+    print("Dashboard map is missing", len(missing["networks"]), "network(s) and", len(missing["devices"]), "device(s). Refreshing Dashboard references...")
+    newmap = get_meraki_http_info()
+    if not newmap:
+        return
+
+    # Patch in the missing entries only. Anything still missing is remembered, so it doesn't trigger another scrape.
+    for linktype in missing:
+        if linktype not in dbmap:
+            dbmap[linktype] = {}
+        for linkname in missing[linktype]:
+            if linkname in newmap.get(linktype, {}):
+                dbmap[linktype][linkname] = newmap[linktype][linkname]
+            else:
+                unresolved_entries[linktype].add(linkname)
+
+    cico_meraki.set_meraki_dashboard_map(dbmap)
+    save_dashboard_map_file(dbmap)
 
 
 def get_meraki_http_info():
@@ -261,20 +376,7 @@ def get_meraki_http_info():
         rjson = json.loads(rcontent[rcontent.find("({")+1:-1])
         #print(rjson)
 
-        outjson = {}
-        mbase = rjson["networks"]
-        outjson = {"networks": {}, "devices": {}}
-        # Now, we will iterate the data loaded from the XHR request to generate the mapping data that we need.
-        for jitem in mbase:
-            # This generates the link to the network
-            outjson["networks"][mbase[jitem]["name"]] = {"baseurl": "https://" + mhost + "/" + mbase[jitem]["tag"] + "/n/" + mbase[jitem]["eid"] + meraki_www_get_path(mbase[jitem]["type"], "")}           #, "id": mbase[jitem]["id"]
-
-            # This generates the link to the device
-            for jdev in rjson["nodes"]:
-                if rjson["nodes"][jdev]["ng_id"] == mbase[jitem]["id"]:
-                    outjson["devices"][rjson["nodes"][jdev]["mac"]] = {"baseurl": "https://" + mhost + "/" + mbase[jitem]["tag"] + "/n/" + mbase[jitem]["eid"] + meraki_www_get_path(mbase[jitem]["type"], rjson["nodes"][jdev]["id"]), "desc": rjson["nodes"][jdev]["name"]}              #mbase[jitem]["id"]          #rjson["nodes"][jdev]["serial"]
-
-        return outjson
+        return build_dashboard_map(rjson, mhost)
     else:
         print("Unable to get org url. Check username and password...")
         return {}
@@ -0,0 +1,82 @@
+'''
+    This module is specifically for the compact record types used to hold Meraki Dashboard API data in memory. The API
+    returns a JSON object per device / client / Systems Manager device, with many fields the bot never looks at. A
+    record keeps only the fields the bot uses, in __slots__ rather than a per-object dictionary. Records can be read
+    the same way as the JSON objects they replace (rec["mac"], rec.get("name"), "switchport" in rec), so the code that
+    formats them does not need to know the difference.
+'''
+
+# ========================================================
+# Initialize Program - Function Definitions
+# ========================================================
+
+
+class MerakiRecord(object):
+    '''
+    Base class for the record types. Subclasses list their fields in __slots__.
+    '''
+    __slots__ = ()
+
+    def __init__(self, data):
+        '''
+        Projects a JSON object (or another record) onto the fields of this record type
+
+        :param data: Dictionary. The JSON object from the Dashboard API. Fields that are missing are set to None.
+        '''
+        for field in self.__slots__:
+            setattr(self, field, data.get(field))
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field):
+        # A field missing from the JSON object is stored as None, so it is only "in" the record if it has a value
+        return field in self.__slots__ and getattr(self, field) is not None
+
+    def get(self, field, default=None):
+        '''
+        Returns a field of the record, like dict.get
+
+        :param field: String. Name of the field
+        :param default: (optional) value to return if the record does not have this field
+        :return: The value of the field
+        '''
+        if field not in self.__slots__:
+            return default
+        return getattr(self, field)
+
+    def replace(self, **changes):
+        '''
+        Returns a copy of the record with some fields changed. Records held by the cache are shared between threads,
+        so they are replaced rather than changed in place.
+
+        :param changes: The fields to change, and their new values
+        :return: A new record of the same type
+        '''
+        newrec = self.__class__.__new__(self.__class__)
+        for field in self.__slots__:
+            setattr(newrec, field, changes.get(field, getattr(self, field)))
+        return newrec
+
+
+class DeviceRecord(MerakiRecord):
+    '''
+    A device, from /organizations/{id}/devices or /organizations/{id}/deviceStatuses
+    '''
+    __slots__ = ("serial", "mac", "model", "name", "networkId", "status")
+
+
+class ClientRecord(MerakiRecord):
+    '''
+    A client, from /devices/{serial}/clients or /networks/{id}/clients
+    '''
+    __slots__ = ("id", "mac", "description", "ip", "vlan", "switchport", "dhcpHostname")
+
+
+class SmRecord(MerakiRecord):
+    '''
+    A Systems Manager device, from /networks/{id}/sm/devices
+    '''
+    __slots__ = ("wifiMac", "name", "tags", "systemModel", "osName", "ssid")
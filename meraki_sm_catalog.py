@@ -0,0 +1,142 @@
+'''
+    This module is specifically for the Meraki Systems Manager (SM) device catalog. The catalog holds every SM device
+    in the organization, with a MAC address index for cross-referencing dashboard clients, and a lowercase n-gram and
+    tag index for searching devices by name or tag. The catalog is built in the background, so a user check does not
+    have to scan (and lowercase) every SM device.
+'''
+
+import threading
+import meraki_records
+
+# Length of the n-grams used for the name index. Searches shorter than this fall back to a scan of the (already
+# lowercased) device names.
+ngram_len = 3
+# The most recent merge of several organizations' catalogs, so it is only rebuilt when one of them changes
+merged_catalog = {"sources": None, "catalog": None}
+merge_lock = threading.Lock()
+# Catalog with no SM devices, used until an organization's catalog has been retrieved. Catalogs are never changed once
+# built, so this can be shared.
+empty_catalog = {"entries": [], "macs": {}, "names": [], "ngrams": {}, "tags": {}}
+
+# ========================================================
+# Initialize Program - Function Definitions
+# ========================================================
+
+
+def get_ngrams(strval):
+    '''
+    Splits a string into its unique n-grams
+
+    :param strval: String. The (lowercase) string to split
+    :return: Set. All substrings of length ngram_len
+    '''
+    return set(strval[x:x + ngram_len] for x in range(0, len(strval) - ngram_len + 1))
+
+
+def build_sm_catalog(smlist):
+    '''
+    Builds the SM device catalog from the result of a /networks/{id}/sm/devices fan-out
+
+    :param smlist: Dictionary. Result of do_multi_get, in the form {networkId: {"devices": [...]}}
+    :return: Dictionary. entries (list of (networkId, meraki_records.SmRecord)), and the macs / names / ngrams / tags
+             indexes, which refer to entries by position
+    '''
+    catalog = {"entries": [], "macs": {}, "names": [], "ngrams": {}, "tags": {}}
+
+    # Iterate list of networks
+    for net in smlist:
+        # If there are devices in the network, iterate them
+        if "devices" in smlist[net]:
+            for cli in smlist[net]["devices"]:
+                entry = len(catalog["entries"])
+                catalog["entries"].append((net, meraki_records.SmRecord(cli)))
+                # Index by mac address, so dashboard clients can be cross-referenced
+                catalog["macs"][cli["wifiMac"]] = entry
+                # Lowercase the name once, and index its n-grams
+                lname = (cli.get("name") or "").lower()
+                catalog["names"].append(lname)
+                for gram in get_ngrams(lname):
+                    if gram in catalog["ngrams"]:
+                        catalog["ngrams"][gram].add(entry)
+                    else:
+                        catalog["ngrams"][gram] = {entry}
+                # Lowercase the tags once, and index them
+                for tag in cli.get("tags") or []:
+                    ltag = tag.lower()
+                    if ltag in catalog["tags"]:
+                        catalog["tags"][ltag].add(entry)
+                    else:
+                        catalog["tags"][ltag] = {entry}
+
+    return catalog
+
+
+def lookup_sm_mac(catalog, mac):
+    '''
+    Looks up an SM device by mac address
+
+    :param catalog: Dictionary. Catalog from build_sm_catalog
+    :param mac: String. Mac address of the client
+    :return: Dictionary. The SM device, or None if there is no SM device with that mac address
+    '''
+    if mac in catalog["macs"]:
+        return catalog["entries"][catalog["macs"][mac]][1]
+    return None
+
+
+def search_sm_catalog(catalog, client_id):
+    '''
+    Finds SM devices whose name contains the search string, or that have a tag equal to it (case-insensitive)
+
+    :param catalog: Dictionary. Catalog from build_sm_catalog
+    :param client_id: String. The search string (usually the username)
+    :return: List. Matching SM devices, in catalog order
+    '''
+    lid = client_id.lower()
+    matches = set(catalog["tags"].get(lid, set()))
+
+    if len(lid) >= ngram_len:
+        # Every n-gram of the search string must be in the name. Start from the rarest n-gram, then confirm each
+        # candidate against the full name.
+        grams = sorted(get_ngrams(lid), key=lambda g: len(catalog["ngrams"].get(g, ())))
+        candidates = set(catalog["ngrams"].get(grams[0], set()))
+        for gram in grams[1:]:
+            if not candidates:
+                break
+            candidates &= catalog["ngrams"].get(gram, set())
+        for entry in candidates:
+            if lid in catalog["names"][entry]:
+                matches.add(entry)
+    else:
+        for entry in range(0, len(catalog["names"])):
+            if lid in catalog["names"][entry]:
+                matches.add(entry)
+
+    return [catalog["entries"][entry][1] for entry in sorted(matches)]
+
+
+def merge_sm_catalogs(catalogs):
+    '''
+    Combines the catalogs of several organizations into one. The result is remembered until one of the catalogs is
+    replaced by a cache refresh.
+
+    :param catalogs: List. Catalogs from build_sm_catalog. Organizations whose catalog has not been retrieved yet may
+                     be None, and are skipped.
+    :return: Dictionary. A catalog containing the entries of every catalog
+    '''
+    catalogs = [catalog for catalog in catalogs if catalog is not None]
+    with merge_lock:
+        if merged_catalog["sources"] is not None and len(merged_catalog["sources"]) == len(catalogs) and \
+                all(a is b for a, b in zip(merged_catalog["sources"], catalogs)):
+            return merged_catalog["catalog"]
+
+        smlist = {}
+        for catalog in catalogs:
+            for net, dev in catalog["entries"]:
+                if net in smlist:
+                    smlist[net]["devices"].append(dev)
+                else:
+                    smlist[net] = {"devices": [dev]}
+        merged_catalog["sources"] = list(catalogs)
+        merged_catalog["catalog"] = build_sm_catalog(smlist)
+        return merged_catalog["catalog"]
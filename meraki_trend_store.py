@@ -0,0 +1,204 @@
+'''
+    This module is specifically for the Meraki health trend store. Each time the device statuses are refreshed, a
+    sample of every network and device is recorded into fixed-size ring buffers (arrays, so memory is bounded by
+    MERAKI_TREND_SAMPLES regardless of how long the bot runs). Running totals of offline time and flaps (a device going
+    from online to offline) are kept up to date as samples are added and dropped, so a trend summary for a network is
+    a constant-time lookup rather than a scan of its samples.
+'''
+import os
+import array
+import threading
+
+# ========================================================
+# Load required parameters from environment variables
+# ========================================================
+
+meraki_trend_samples = os.getenv("MERAKI_TREND_SAMPLES")
+if not meraki_trend_samples:
+    meraki_trend_samples = "1440"
+
+# Trend store for each organization, keyed by organization id
+trend_stores = {}
+trend_lock = threading.Lock()
+
+# ========================================================
+# Initialize Program - Function Definitions
+# ========================================================
+
+
+def new_trend_store():
+    '''
+    Creates an empty trend store
+
+    :return: Dictionary. The sample times and spans (seconds since the previous sample), the networks and devices, and
+             the position of the next sample
+    '''
+    size = max(1, int(meraki_trend_samples))
+    return {"size": size, "pos": 0, "count": 0, "version": None, "times": array.array("d", [0.0] * size),
+            "spans": array.array("d", [0.0] * size), "networks": {}, "devices": {}}
+
+
+def new_trend(size):
+    '''
+    Creates the ring buffers and running totals for a single network or device
+
+    :param size: Integer. Number of samples in the ring buffers
+    :return: Dictionary. offline (number of devices offline in each sample), flaps (number of devices that went
+             offline in each sample), offline_secs and flap_total (running totals over the samples in the buffers)
+    '''
+    return {"offline": array.array("H", [0] * size), "flaps": array.array("H", [0] * size), "offline_secs": 0.0,
+            "flap_total": 0, "last": {}}
+
+
+def drop_sample(trend, pos, span):
+    '''
+    Removes the sample at a position from a trend's running totals, before it is overwritten
+
+    :param trend: Dictionary. Network or device trend, from new_trend
+    :param pos: Integer. Position of the sample in the ring buffers
+    :param span: Float. Seconds covered by the sample
+    :return: Nothing
+    '''
+    if trend["offline"][pos] > 0:
+        trend["offline_secs"] -= span
+    trend["flap_total"] -= trend["flaps"][pos]
+
+
+def add_sample(trend, pos, span, statuses):
+    '''
+    Records a sample into a trend's ring buffers and running totals
+
+    :param trend: Dictionary. Network or device trend, from new_trend
+    :param pos: Integer. Position of the sample in the ring buffers
+    :param span: Float. Seconds covered by the sample (since the previous sample)
+    :param statuses: Dictionary. Whether each device is offline, keyed by serial
+    :return: Nothing
+    '''
+    offline = 0
+    flaps = 0
+    for serial in statuses:
+        if statuses[serial]:
+            offline += 1
+            # A device that was online in the previous sample has flapped
+            if trend["last"].get(serial) is False:
+                flaps += 1
+    trend["last"] = statuses
+    trend["offline"][pos] = min(offline, 65535)
+    trend["flaps"][pos] = min(flaps, 65535)
+    if offline > 0:
+        trend["offline_secs"] += span
+    trend["flap_total"] += flaps
+
+
+def record_sample(org, sampletime, netstatus, version):
+    '''
+    Records a sample of every network and device in an organization. Networks and devices that are no longer present
+    are dropped from the store.
+
+    :param org: String. Organization id
+    :param sampletime: Float. Time of the sample
+    :param netstatus: Dictionary. {dashboard network name: {serial: true if offline}}
+    :param version: Integer. Version of the device statuses the sample was taken from; a sample is only recorded once
+                    per version
+    :return: Nothing
+    '''
+    with trend_lock:
+        if org not in trend_stores:
+            trend_stores[org] = new_trend_store()
+        store = trend_stores[org]
+        if store["version"] == version:
+            return
+        store["version"] = version
+
+        pos = store["pos"]
+        span = 0.0
+        if store["count"] > 0:
+            span = sampletime - store["times"][(pos - 1) % store["size"]]
+        # When the buffers are full, the oldest sample is overwritten; take it out of the running totals first
+        if store["count"] == store["size"]:
+            oldspan = store["spans"][pos]
+            for trend in list(store["networks"].values()) + list(store["devices"].values()):
+                drop_sample(trend, pos, oldspan)
+        store["times"][pos] = sampletime
+        store["spans"][pos] = span
+
+        devices = {}
+        for netname in netstatus:
+            if netname not in store["networks"]:
+                store["networks"][netname] = new_trend(store["size"])
+            add_sample(store["networks"][netname], pos, span, netstatus[netname])
+            for serial in netstatus[netname]:
+                devices[serial] = netstatus[netname][serial]
+                if serial not in store["devices"]:
+                    store["devices"][serial] = new_trend(store["size"])
+                add_sample(store["devices"][serial], pos, span, {serial: netstatus[netname][serial]})
+
+        for netname in [n for n in store["networks"] if n not in netstatus]:
+            del store["networks"][netname]
+        for serial in [d for d in store["devices"] if d not in devices]:
+            del store["devices"][serial]
+
+        store["pos"] = (pos + 1) % store["size"]
+        store["count"] = min(store["count"] + 1, store["size"])
+
+
+def get_trend_window(org):
+    '''
+    Returns how much time the samples in an organization's trend store cover
+
+    :param org: String. Organization id
+    :return: Tuple. (number of samples, seconds between the oldest and newest sample)
+    '''
+    with trend_lock:
+        store = trend_stores.get(org)
+        if not store or store["count"] == 0:
+            return 0, 0
+        newest = store["times"][(store["pos"] - 1) % store["size"]]
+        oldest = store["times"][(store["pos"] - store["count"]) % store["size"]]
+        return store["count"], int(newest - oldest)
+
+
+def get_trend(org, trendtype, key):
+    '''
+    Returns the running totals for a network or device
+
+    :param org: String. Organization id
+    :param trendtype: String. 'networks' or 'devices'
+    :param key: String. Dashboard network name, or device serial
+    :return: Dictionary. offline_secs (seconds with a device offline) and flaps, or None if there is no trend for it
+    '''
+    with trend_lock:
+        store = trend_stores.get(org)
+        if not store or key not in store[trendtype]:
+            return None
+        trend = store[trendtype][key]
+        return {"offline_secs": int(trend["offline_secs"]), "flaps": trend["flap_total"]}
+
+
+def get_trend_names(org):
+    '''
+    Returns the networks that have a trend
+
+    :param org: String. Organization id
+    :return: List. Dashboard network names, sorted
+    '''
+    with trend_lock:
+        store = trend_stores.get(org)
+        if not store:
+            return []
+        return sorted(store["networks"])
+
+
+def get_trend_devices(org, netname):
+    '''
+    Returns the devices that were in a network in the most recent sample
+
+    :param org: String. Organization id
+    :param netname: String. Dashboard network name
+    :return: List. Device serials, sorted
+    '''
+    with trend_lock:
+        store = trend_stores.get(org)
+        if not store or netname not in store["networks"]:
+            return []
+        return sorted(store["networks"][netname]["last"])
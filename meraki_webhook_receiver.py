@@ -0,0 +1,134 @@
+'''
+    This module is specifically for receiving Meraki Dashboard webhook alerts. Device down / up alerts are applied to
+    the cached device status snapshot as they arrive, so meraki-health reflects them within seconds. The full device
+    status poll is kept as a consistency backstop, but runs much less often (MERAKI_WEBHOOK_STATUS_TTL).
+
+    To test without a dashboard, this module can also be run directly to post a sample alert to the bot:
+        python meraki_webhook_receiver.py http://localhost:5000/meraki-webhook Q2XX-XXXX-XXXX down
+'''
+import os
+import sys
+import hmac
+import json
+import datetime
+import requests
+from flask import request
+import meraki_cache
+
+# ========================================================
+# Load required parameters from environment variables
+# ========================================================
+
+meraki_webhook_secret = os.getenv("MERAKI_WEBHOOK_SECRET")
+meraki_webhook_path = os.getenv("MERAKI_WEBHOOK_PATH")
+if not meraki_webhook_path:
+    meraki_webhook_path = "/meraki-webhook"
+meraki_webhook_status_ttl = os.getenv("MERAKI_WEBHOOK_STATUS_TTL")
+if not meraki_webhook_status_ttl:
+    meraki_webhook_status_ttl = "900"
+
+# ========================================================
+# Initialize Program - Function Definitions
+# ========================================================
+
+
+def get_alert_status(alert):
+    '''
+    Works out the device status that an alert reports
+
+    :param alert: Dictionary. The webhook alert
+    :return: String. 'online' or 'offline', or None if this is not a device down / up alert
+    '''
+    alerttype = (str(alert.get("alertTypeId") or "") + " " + str(alert.get("alertType") or "")).lower().replace("_", " ")
+    if "went down" in alerttype:
+        return "offline"
+    if "came up" in alerttype:
+        return "online"
+    return None
+
+
+def apply_alert(alert):
+    '''
+    Applies a device down / up alert to the cached device status snapshot. Devices that are not in the snapshot yet are
+    left for the next full status poll.
+
+    :param alert: Dictionary. The webhook alert
+    :return: true/false based on whether the alert changed a device status
+    '''
+    newstatus = get_alert_status(alert)
+    serial = alert.get("deviceSerial")
+    if not newstatus or not serial:
+        return False
+
+    changed = []
+
+    def set_status(statdict):
+        if serial in statdict and statdict[serial].get("status") != newstatus:
+            # Replace the entry rather than changing it, so a health check in progress sees a consistent device
+            statdict[serial] = statdict[serial].replace(status=newstatus)
+            changed.append(serial)
+
+    # In multi-organization mode, each organization has its own statuses tier; serial numbers are unique, so the alert
+    # is offered to each of them
+    for tiername in list(meraki_cache.cache_tiers):
+        if tiername == "statuses" or tiername.startswith("statuses@"):
+            meraki_cache.update_tier(tiername, set_status)
+    return len(changed) > 0
+
+
+def receive_meraki_alert():
+    '''
+    Flask view for the Meraki webhook endpoint. Alerts without the configured shared secret are rejected.
+
+    :return: Tuple. Response body and HTTP status code
+    '''
+    alert = request.get_json(silent=True)
+    if not isinstance(alert, dict):
+        return "Bad Request", 400
+    if not hmac.compare_digest(str(alert.get("sharedSecret") or ""), meraki_webhook_secret):
+        return "Forbidden", 403
+
+    if apply_alert(alert):
+        print("Meraki alert applied:", alert.get("deviceSerial"), alert.get("alertType"))
+    return "OK", 200
+
+
+def register_webhook(app):
+    '''
+    Adds the webhook endpoint to the bot's Flask app, and relaxes the device status poll to a backstop, since alerts now
+    keep the statuses up to date
+
+    :param app: Flask. The bot
+    :return: Nothing
+    '''
+    app.add_url_rule(meraki_webhook_path, "meraki_webhook", receive_meraki_alert, methods=["POST"])
+    meraki_cache.meraki_cache_status_ttl = meraki_webhook_status_ttl
+    for tiername in list(meraki_cache.cache_tiers):
+        if tiername == "statuses" or tiername.startswith("statuses@"):
+            meraki_cache.set_tier_ttl(tiername, meraki_webhook_status_ttl)
+
+
+def post_sample_alert(url, serial, state):
+    '''
+    Posts a sample device down / up alert, in the form sent by the Meraki Dashboard. Used for testing.
+
+    :param url: String. URL of the webhook endpoint
+    :param serial: String. Serial number of the device
+    :param state: String. 'down' or 'up'
+    :return: Response. The response from the bot
+    '''
+    if state == "down":
+        alerttype = "Device went down"
+    else:
+        alerttype = "Device came up"
+    alert = {"version": "0.1", "sharedSecret": meraki_webhook_secret, "sentAt": datetime.datetime.utcnow().isoformat() + "Z",
+             "organizationId": "", "networkId": "", "deviceSerial": serial, "alertType": alerttype, "alertData": {}}
+    return requests.post(url, data=json.dumps(alert), headers={"Content-Type": "application/json"})
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[3] not in ("down", "up"):
+        print("Usage: python meraki_webhook_receiver.py <webhook url> <device serial> <down|up>")
+        sys.exit()
+    resp = post_sample_alert(sys.argv[1], sys.argv[2], sys.argv[3])
+    print(resp.status_code, resp.text)